@@ -2,7 +2,8 @@ from init import db
 from sqlalchemy.orm import validates
 import re
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import date
+from datetime import date, datetime, timedelta
+from itertools import groupby
 
 
 class User(db.Model):
@@ -77,27 +78,52 @@ class Book(db.Model):
     book_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
     file_name = db.Column(db.String)
+    pdf_status = db.Column(db.String)  # pending, ready or failed
+    pdf_render = db.Column(db.Integer, nullable=False, default=0)  # latest queued render
     authors = db.Column(db.String, nullable=False)
     content = db.Column(db.String)
     issue_date = db.Column(db.Date)
-    return_date = db.Column(db.Date)
+    return_date = db.Column(db.Date, index=True)
     section_id = db.Column(db.Integer, db.ForeignKey(
-        "Section.section_id"), nullable=False)
-    user_email = db.Column(db.String, db.ForeignKey("user.email"))
+        "Section.section_id"), nullable=False, index=True)
+    user_email = db.Column(db.String, db.ForeignKey(
+        "user.email"), index=True)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now,
+                           onupdate=datetime.now, index=True)
     feedbacks = db.relationship("Feedback", back_populates="book")
     owners = db.relationship("Owner", backref="Book")
     readby = db.relationship("Read", back_populates="book")
+    __table_args__ = (db.Index("ix_Book_rating_book_id", "rating", "book_id"),)
 
     @classmethod
-    def due_users(cls):
-        books = cls.query.filter(Book.return_date <= date.today()).all()
-        user_dict = {}
-        for book in books:
-            user = User.query.filter_by(email=book.user_email).first()
-            if not user in user_dict:
-                user_dict[user] = []
-            user_dict[user].append(book)
-        return user_dict
+    def due_users(cls, days=0, batch=1000):
+        # streams (email, nick_name, [book names]) for loans due within `days` days
+        rows = db.session.query(User.email, User.nick_name, cls.name).join(User, User.email == cls.user_email).filter(
+            cls.return_date <= date.today() + timedelta(days=days)).order_by(User.email, cls.book_id).yield_per(batch)
+        for (email, nick_name), books in groupby(rows, key=lambda row: (row[0], row[1])):
+            yield email, nick_name, [name for _, _, name in books]
+
+    @classmethod
+    def add_rating(cls, book_id, rating):
+        # runs inside the caller's transaction, so the aggregate commits with the feedback
+        cls.query.filter_by(book_id=book_id).update({
+            cls.rating_sum: cls.rating_sum + rating,
+            cls.rating_count: cls.rating_count + 1,
+            cls.rating: (cls.rating_sum + rating) * 1.0 / (cls.rating_count + 1),
+        }, synchronize_session=False)
+
+    def queue_render(self):
+        # returns the token the render task has to present
+        self.pdf_status = "pending"
+        self.pdf_render = (self.pdf_render or 0) + 1
+        return self.pdf_render
+
+    @classmethod
+    def by_rating(cls):
+        return cls.query.order_by(cls.rating.desc(), cls.book_id.desc())
 
     def return_data(self):
         return dict(id=self.book_id, name=self.name, authors=self.authors, section_id=int(self.section_id), email=self.user_email, content=self.content, return_date=self.return_date, issue_date=self.issue_date)
@@ -109,6 +135,8 @@ class Section(db.Model):
     name = db.Column(db.String, nullable=False)
     date_created = db.Column(db.Date, nullable=False)
     description = db.Column(db.String, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now,
+                           onupdate=datetime.now, index=True)
     books = db.relationship("Book", backref="Section")
 
     def return_data(self):
@@ -120,8 +148,8 @@ class Section(db.Model):
 class Feedback(db.Model):
     __tablename__ = "Feedback"
     feedback_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    book_id = db.Column(db.String, db.ForeignKey(
-        "Book.book_id"), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey(
+        "Book.book_id"), nullable=False, index=True)
     user_name = db.Column(db.String, db.ForeignKey(
         "user.email"), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
@@ -143,50 +171,58 @@ class Feedback(db.Model):
 class Requests(db.Model):
     __tablename__ = "Requests"
     request_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    user_id = db.Column(db.String, db.ForeignKey('user.email'), nullable=False)
-    book_id = db.Column(db.String, db.ForeignKey(
+    user_id = db.Column(db.String, db.ForeignKey(
+        'user.email'), nullable=False, index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey(
         'Book.book_id'), nullable=False)
-    pending = db.Column(db.Boolean, default=True)
+    pending = db.Column(db.Boolean, default=True, index=True)
     opened_on = db.Column(db.Date)
     closed_on = db.Column(db.Date)
     outcome = db.Column(db.String)
+    updated_at = db.Column(db.DateTime, default=datetime.now,
+                           onupdate=datetime.now, index=True)
 
     @classmethod
     def requests_in_period(cls, start_date, end_date):
-        requests = cls.query.filter(
-            cls.opened_on >= start_date, cls.opened_on <= end_date).all()
-        requests = [request.return_data() for request in requests]
-        return requests
+        requests = cls.with_holder(cls.query.filter(
+            cls.opened_on >= start_date, cls.opened_on <= end_date)).all()
+        return cls.serialize(requests)
 
     @classmethod
     def get_requests(cls, user_email, start_date):
-        requests = cls.query.filter(
-            cls.user_id == user_email, cls.opened_on >= start_date).all()
-        requests = [request.return_data() for request in requests]
-        return requests
+        requests = cls.with_holder(cls.query.filter(
+            cls.user_id == user_email, cls.opened_on >= start_date)).all()
+        return cls.serialize(requests)
 
-    def return_data(self):
-        book = Book.query.filter_by(book_id=self.book_id).first()
-        if book is None:
-            withu = ""
-        else:
-            withu = book.user_email
+    @classmethod
+    def with_holder(cls, query=None):
+        # each request next to the current holder of its book, in one round-trip
+        query = query if query is not None else cls.query
+        return query.outerjoin(Book, Book.book_id == cls.book_id).add_columns(
+            Book.book_id.label("known_book"), Book.user_email.label("holder"))
+
+    @staticmethod
+    def serialize(rows):
+        return [request.data("" if known_book is None else holder) for request, known_book, holder in rows]
+
+    def data(self, withu):
         return dict(id=self.request_id, user_id=self.user_id, book_id=self.book_id, pending=self.pending, opened_on=self.opened_on, closed_on=self.closed_on, outcome=self.outcome, withu=withu)
 
 
 class Owner(db.Model):
     __tablename__ = "Owner"
     owner_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    user_email = db.Column(db.String, db.ForeignKey("user.email"))
-    book_id = db.Column(db.String, db.ForeignKey(
+    user_email = db.Column(db.String, db.ForeignKey("user.email"), index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey(
         "Book.book_id"), nullable=False)
 
 
 class Read(db.Model):
     __tablename__ = "Read"
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    user_id = db.Column(db.String, db.ForeignKey('user.email'), nullable=False)
-    book_id = db.Column(db.String, db.ForeignKey(
+    user_id = db.Column(db.String, db.ForeignKey(
+        'user.email'), nullable=False, index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey(
         'Book.book_id'), nullable=False)
     book = db.relationship("Book", back_populates="readby")
     on = db.Column(db.Date, nullable=False)
@@ -197,12 +233,32 @@ class VisitHistory(db.Model):
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.String, db.ForeignKey('user.email'), nullable=False)
     on = db.Column(db.Date, nullable=False)
+    __table_args__ = (db.Index("uq_VisitHistory_user_id_on",
+                      "user_id", "on", unique=True),)
 
     @classmethod
-    def unvisited(cls):
-        visited_users = cls.query.filter_by(on=date.today()).all()
-        users = set()
-        for history in visited_users:
-            users.add(User.query.filter_by(email=history.user_id).first())
-        all_users = set(User.query.all())
-        return all_users - users
+    def unvisited(cls, day=None, batch=1000):
+        # streams (email, nick_name) of users with no visit on the day
+        day = day or date.today()
+        visited = db.session.query(cls.id).filter(
+            cls.user_id == User.email, cls.on == day).exists()
+        users = db.session.query(User.email, User.nick_name).filter(
+            ~visited).yield_per(batch)
+        for email, nick_name in users:
+            yield email, nick_name
+
+
+class ExportWatermark(db.Model):
+    __tablename__ = "ExportWatermark"
+    entity = db.Column(db.String, primary_key=True)
+    last_modified = db.Column(db.DateTime)
+    last_id = db.Column(db.Integer)
+    exported_at = db.Column(db.DateTime, nullable=False)
+
+
+class Blob(db.Model):
+    __tablename__ = "Blob"
+    digest = db.Column(db.String, primary_key=True)  # sha256 of the content
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    released_on = db.Column(db.DateTime)  # when refcount last dropped to 0
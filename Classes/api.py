@@ -2,6 +2,7 @@ from init import app
 from flask_restful import Resource,reqparse
 from Classes.Dbmodels import Book
 from init import api,db
+from Classes import blobs, invalidation
 
 errors = {
     "NFB":"Book not found",
@@ -35,14 +36,18 @@ class bookResource(Resource):
         book = Book.query.filter_by(book_id = book_id).first()
         if book is None:
             return errors['NFB'],404
+        blobs.release(book.file_name)
         db.session.delete(book)
         db.session.commit()
+        invalidation.book_changed(book_id)
+        invalidation.catalog_changed()
         return "Done",200
     def post(self):
         args = bookparser_post.parse_args()
         book = Book(**args)
         db.session.add(book)
         db.session.commit()
+        invalidation.catalog_changed()
         return {'ID': book.book_id,'Name': book.name,'Section Id':book.section_id,
                 'Authors':book.authors,'Content':book.content},200
     def put(self,book_id):
@@ -56,6 +61,8 @@ class bookResource(Resource):
         if args["section_id"] is not None: book.section_id = args["section_id"]
         db.session.add(book)
         db.session.commit()
+        invalidation.book_changed(book_id)
+        invalidation.catalog_changed()
         return {'ID': book.book_id,'Name': book.name,'Section Id':book.section_id,
                 'Authors':book.authors,'Content':book.content},200
 
@@ -0,0 +1,155 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from flask import request, jsonify
+import jwt
+from init import app, db
+from Classes.Dbmodels import User, Librarian
+from Classes import presence
+
+"""
+Token authentication
+
+The token is checked on every request, the account behind it is not: a short
+lived in-process LRU maps (role, subject) to a snapshot of the account's
+columns. Handlers get a Principal that answers from the snapshot and loads the
+ORM row only when something else is asked of it (relationships, methods,
+writes). Profile edits and logout drop the entry; in other processes it ages
+out after AUTH_CACHE_TTL seconds, so anything cached for longer than that is
+built from .record, never from the snapshot.
+"""
+
+# model behind each token role, secret columns never go in the cache
+ROLES = {
+    "user": User,
+    "librarian": Librarian,
+}
+SECRETS = {"user_pass", "password"}
+
+invalid_msg = {
+    'message': 'Invalid token',
+    'authenticated': False,
+    'invalid': True
+}
+expired_msg = {
+    'message': 'Expired token',
+    'authenticated': False,
+    'invalid': True
+}
+
+
+class PrincipalCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+principals = PrincipalCache(
+    app.config["AUTH_CACHE_SIZE"], app.config["AUTH_CACHE_TTL"])
+
+
+class Principal:
+    def __init__(self, role, subject, snapshot, record=None):
+        self.__dict__.update(_role=role, _subject=subject,
+                             _snapshot=snapshot, _record=record)
+
+    @property
+    def record(self):
+        if self._record is None:
+            record = db.session.get(ROLES[self._role], self._subject)
+            if record is None:
+                raise RuntimeError(f'{self._role} not found')
+            self.__dict__["_record"] = record
+        return self._record
+
+    def return_data(self):
+        return dict(self._snapshot["data"])
+
+    def __getattr__(self, name):
+        fields = self._snapshot["fields"]
+        if name in fields and self._record is None:
+            return fields[name]
+        return getattr(self.record, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.record, name, value)
+
+
+def snapshot(record):
+    fields = {column.name: getattr(record, column.name)
+              for column in record.__table__.columns if column.name not in SECRETS}
+    return dict(fields=fields, data=record.return_data())
+
+
+def load_principal(role, subject):
+    key = (role, subject)
+    cached = principals.get(key)
+    if cached is not None:
+        return Principal(role, subject, cached)
+    record = db.session.get(ROLES[role], subject)
+    if record is None:
+        return None
+    cached = snapshot(record)
+    principals.put(key, cached)
+    if role == "user":
+        # at most one heartbeat per user per AUTH_CACHE_TTL in each process
+        presence.heartbeat(subject)
+    return Principal(role, subject, cached, record)
+
+
+def forget(role, subject):
+    principals.discard((role, subject))
+
+
+def token_required(role):
+    def decorator(fun):
+        @wraps(fun)
+        def _verify(*args, **kwargs):
+            auth_headers = request.headers.get('Authorization', '').split()
+            if len(auth_headers) != 2:
+                return jsonify(invalid_msg), 401
+
+            try:
+                token = auth_headers[1]
+                data = jwt.decode(
+                    token, app.config['SECRET_KEY'], algorithms="HS256")
+                if data['role'] != role:
+                    return jsonify(invalid_msg), 401
+                principal = load_principal(role, data['email'])
+                if principal is None:
+                    raise RuntimeError(f'{role} not found')
+                return fun(principal, *args, **kwargs)
+            except jwt.ExpiredSignatureError:
+                return jsonify(expired_msg), 401
+            except (jwt.InvalidTokenError, Exception) as e:
+                print(e)
+                return jsonify(invalid_msg), 401
+
+        return _verify
+    return decorator
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import case
+from init import app, db
+from Classes.Dbmodels import Blob
+
+"""
+Content addressed book files
+
+A pdf is stored once under static/blobs/<sha256>.pdf whatever the number of
+books using it, and Book.file_name is that path relative to the upload
+folder. Uploads are hashed while they stream to disk. Each blob counts the
+books pointing at it; dropping to zero only marks it, collect() deletes
+blobs left unreferenced for BLOB_GC_GRACE seconds from a periodic task. The
+content never changes under a name, so the URLs can be cached forever.
+
+Placing a file always moves the fresh copy in, even over an identical one,
+and collect() only unlinks a file that was not placed within the grace
+period, with the blob row's delete still uncommitted. A book picking a blob
+up while it is being collected therefore always finds the file on disk.
+"""
+
+CHUNK = 1 << 16
+PREFIX = "blobs/"
+
+
+def folder():
+    return os.path.join(app.config["UPLOAD_FOLDER"], "blobs")
+
+
+def scratch():
+    # a temporary file next to the blobs, so placing it is a rename
+    os.makedirs(folder(), exist_ok=True)
+    handle, path = tempfile.mkstemp(dir=folder(), suffix=".part")
+    os.close(handle)
+    return path
+
+
+def place(path, digest):
+    # the content is the same, replacing restores a file collect() may be
+    # deleting right now; the fresh mtime tells collect() to keep it
+    os.makedirs(folder(), exist_ok=True)
+    os.utime(path)
+    os.replace(path, os.path.join(folder(), digest + ".pdf"))
+    return PREFIX + digest + ".pdf"
+
+
+def ingest(stream):
+    # writes the stream to disk, hashing as it goes; returns the file_name
+    path = scratch()
+    digest = hashlib.sha256()
+    try:
+        with open(path, "wb") as out:
+            for chunk in iter(lambda: stream.read(CHUNK), b""):
+                digest.update(chunk)
+                out.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return place(path, digest.hexdigest())
+
+
+def store_file(path):
+    # moves an existing file into the store; returns the file_name
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(CHUNK), b""):
+            digest.update(chunk)
+    return place(path, digest.hexdigest())
+
+
+def digest_of(file_name):
+    if file_name and file_name.startswith(PREFIX):
+        return file_name[len(PREFIX):-len(".pdf")]
+    return None
+
+
+def acquire(file_name):
+    # both counts run inside the caller's transaction
+    digest = digest_of(file_name)
+    updated = Blob.query.filter_by(digest=digest).update(
+        {Blob.refcount: Blob.refcount + 1, Blob.released_on: None}, synchronize_session=False)
+    path = os.path.join(app.config["UPLOAD_FOLDER"], file_name)
+    if not os.path.exists(path):
+        # only a file placed by this caller can be picked up
+        raise FileNotFoundError(path)
+    if not updated:
+        db.session.add(Blob(digest=digest, size=os.path.getsize(path), refcount=1))
+
+
+def release(file_name):
+    digest = digest_of(file_name)
+    if digest is None:
+        return
+    Blob.query.filter_by(digest=digest).update({
+        Blob.refcount: Blob.refcount - 1,
+        Blob.released_on: case((Blob.refcount <= 1, datetime.now()), else_=None),
+    }, synchronize_session=False)
+
+
+def swap(book, file_name):
+    acquire(file_name)
+    release(book.file_name)
+    book.file_name = file_name
+
+
+def collect(grace=None):
+    # deletes the blobs nobody has used for the grace period
+    grace = app.config["BLOB_GC_GRACE"] if grace is None else grace
+    cutoff = datetime.now() - timedelta(seconds=grace)
+    digests = [digest for digest, in db.session.query(Blob.digest).filter(
+        Blob.refcount <= 0, Blob.released_on <= cutoff)]
+    removed = 0
+    for digest in digests:
+        # a book may have picked the blob up again since the select; the
+        # delete holds the write lock until the file is dealt with, so acquire()
+        # waits for it
+        deleted = Blob.query.filter(Blob.digest == digest, Blob.refcount <= 0).delete(
+            synchronize_session=False)
+        if deleted:
+            unlink_stale(digest, cutoff)
+            removed += 1
+        db.session.commit()
+    return removed
+
+
+def unlink_stale(digest, cutoff):
+    # moved aside first, so a file placed meanwhile is never the one removed
+    path = os.path.join(folder(), digest + ".pdf")
+    doomed = f"{path}.{os.getpid()}.gc"
+    try:
+        os.replace(path, doomed)
+    except FileNotFoundError:
+        return
+    if datetime.fromtimestamp(os.path.getmtime(doomed)) > cutoff:
+        # placed again since it was released, a new row follows
+        os.replace(doomed, path)
+    else:
+        os.remove(doomed)
@@ -0,0 +1,185 @@
+from sqlalchemy import func
+from init import cache, db
+from Classes.Dbmodels import Book, Section, Owner
+from Classes.invalidation import TIMEOUT, generations, tagged_key, remember
+from Classes.pagination import keyset, page, encode_cursor
+
+"""
+Shared catalog cache
+
+The rating order and section layout are cached once per catalog generation,
+each book's data once per book generation, so a change to one book (a loan, a
+return) only recomputes that book. The per-user bits (owner flag, books in
+possession) are a small overlay merged at response time.
+
+A page of sections embeds the first SECTION_PREVIEW books of each section and
+a books_cursor for the rest, which the per-section book list continues, so a
+page stays the same size however big the sections grow.
+"""
+
+# keeps IN (...) below SQLite's bound parameter limit
+CHUNK = 500
+SECTION_PREVIEW = 20
+
+
+def book_data(book):
+    data = book.return_data()
+    data["rating"] = round(book.rating, 2)
+    return data
+
+
+def catalog_order():
+    # (book_id, section_id) pairs, best rated first
+    def compute():
+        return [(book_id, section_id) for book_id, section_id in db.session.query(Book.book_id, Book.section_id).order_by(
+            Book.rating.desc(), Book.book_id.desc())]
+    return remember(tagged_key("catalog:order", "catalog"), compute)
+
+
+def catalog_sections():
+    def compute():
+        books = {}
+        for book_id, section_id in catalog_order():
+            books.setdefault(section_id, []).append(book_id)
+        return [dict(id=section.section_id, name=section.name, description=section.description,
+                     books=books.get(section.section_id, [])) for section in Section.query.all()]
+    return remember(tagged_key("catalog:sections", "catalog"), compute)
+
+
+def book_entries(book_ids):
+    if not book_ids:
+        return []
+    gens = generations(*[f"book:{book_id}" for book_id in book_ids])
+    keys = [f"catalog:book:{book_id}@{gen}" for book_id,
+            gen in zip(book_ids, gens)]
+    entries = dict(zip(book_ids, cache.get_many(*keys)))
+    missing = [book_id for book_id, entry in entries.items() if entry is None]
+    if missing:
+        fetched = {}
+        for start in range(0, len(missing), CHUNK):
+            for book in Book.query.filter(Book.book_id.in_(missing[start:start+CHUNK])):
+                fetched[book.book_id] = book_data(book)
+        cache.set_many({key: fetched[book_id] for book_id, key in zip(
+            book_ids, keys) if book_id in fetched}, timeout=TIMEOUT)
+        entries.update(fetched)
+    return [entries[book_id] for book_id in book_ids if entries[book_id] is not None]
+
+
+def user_overlay(user):
+    def compute():
+        owned = db.session.query(Owner.book_id).filter(
+            Owner.user_email == user.email)
+        possessed = db.session.query(Book.book_id).filter(
+            Book.user_email == user.email)
+        return dict(owned=set(book_id for book_id, in owned),
+                    possessed=set(book_id for book_id, in possessed))
+    return remember(tagged_key(f"catalog:user:{user.email}", f"user:{user.email}"), compute)
+
+
+def apply_overlay(books, overlay):
+    return [dict(book, owner=book["id"] in overlay["owned"]) for book in books]
+
+
+def user_books(user):
+    books = book_entries([book_id for book_id, _ in catalog_order()])
+    return apply_overlay(books, user_overlay(user))
+
+
+def user_accessible_books(user):
+    overlay = user_overlay(user)
+    books = book_entries([book_id for book_id, _ in catalog_order()
+                          if book_id in overlay["possessed"]])
+    return apply_overlay(books, overlay)
+
+
+def user_sections(user):
+    overlay = user_overlay(user)
+    books = {book["id"]: book for book in book_entries(
+        [book_id for book_id, _ in catalog_order()])}
+    return [dict(section, books=apply_overlay([books[book_id] for book_id in section["books"] if book_id in books], overlay))
+            for section in catalog_sections()]
+
+
+def librarian_data(book):
+    # librarian views keep the plain Book.return_data shape, in id order
+    return {key: value for key, value in book.items() if key != "rating"}
+
+
+def librarian_books():
+    book_ids = sorted(book_id for book_id, _ in catalog_order())
+    return [librarian_data(book) for book in book_entries(book_ids)]
+
+
+def librarian_sections():
+    books = {book["id"]: book for book in book_entries(
+        [book_id for book_id, _ in catalog_order()])}
+    return [dict(section, books=[librarian_data(books[book_id]) for book_id in sorted(section["books"]) if book_id in books])
+            for section in catalog_sections()]
+
+
+def section_books(section_ids, columns, descending):
+    # the first SECTION_PREVIEW book ids of each section in the order of
+    # columns, and the cursor the section's book list continues from (None
+    # when that was all); one query, ranked within each section
+    order = [column.desc() if descending else column for column in columns]
+    ranked = db.session.query(
+        Book.book_id, Book.section_id, *[column.label(f"key{i}") for i, column in enumerate(columns)],
+        func.row_number().over(partition_by=Book.section_id, order_by=order).label("rank")).filter(
+        Book.section_id.in_(section_ids)).subquery()
+    books = {section_id: [] for section_id in section_ids}
+    cursors = dict.fromkeys(section_ids)
+    keys = [ranked.c[f"key{i}"] for i in range(len(columns))]
+    last = {}
+    for row in db.session.query(ranked.c.book_id, ranked.c.section_id, *keys).filter(
+            ranked.c.rank <= SECTION_PREVIEW + 1).order_by(ranked.c.section_id, ranked.c.rank):
+        if len(books[row.section_id]) == SECTION_PREVIEW:
+            cursors[row.section_id] = encode_cursor(last[row.section_id])
+            continue
+        books[row.section_id].append(row.book_id)
+        last[row.section_id] = list(row[2:])
+    return books, cursors
+
+
+def user_books_page(user, after, limit, section_id=None):
+    query = db.session.query(Book.book_id, Book.rating)
+    if section_id is not None:
+        query = query.filter(Book.section_id == section_id)
+    rows, next_cursor = keyset(query, [Book.rating, Book.book_id], after, limit, descending=True)
+    books = book_entries([row.book_id for row in rows])
+    return page(apply_overlay(books, user_overlay(user)), next_cursor)
+
+
+def user_sections_page(user, after, limit):
+    sections, next_cursor = keyset(
+        Section.query, [Section.section_id], after, limit)
+    books, cursors = section_books([section.section_id for section in sections],
+                                   [Book.rating, Book.book_id], descending=True)
+    entries = {book["id"]: book for book in book_entries(
+        [book_id for ids in books.values() for book_id in ids])}
+    overlay = user_overlay(user)
+    return page([dict(id=section.section_id, name=section.name, description=section.description,
+                      books=apply_overlay([entries[book_id] for book_id in books[section.section_id] if book_id in entries], overlay),
+                      books_cursor=cursors[section.section_id])
+                 for section in sections], next_cursor)
+
+
+def librarian_books_page(after, limit, section_id=None):
+    query = db.session.query(Book.book_id)
+    if section_id is not None:
+        query = query.filter(Book.section_id == section_id)
+    rows, next_cursor = keyset(query, [Book.book_id], after, limit)
+    books = book_entries([row.book_id for row in rows])
+    return page([librarian_data(book) for book in books], next_cursor)
+
+
+def librarian_sections_page(after, limit):
+    sections, next_cursor = keyset(
+        Section.query, [Section.section_id], after, limit)
+    books, cursors = section_books(
+        [section.section_id for section in sections], [Book.book_id], descending=False)
+    entries = {book["id"]: book for book in book_entries(
+        [book_id for ids in books.values() for book_id in ids])}
+    return page([dict(id=section.section_id, name=section.name, description=section.description,
+                      books=[librarian_data(entries[book_id]) for book_id in books[section.section_id] if book_id in entries],
+                      books_cursor=cursors[section.section_id])
+                 for section in sections], next_cursor)
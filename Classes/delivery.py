@@ -0,0 +1,44 @@
+import os
+from flask import request
+from init import app
+from Classes import blobs
+
+"""
+File delivery
+
+Book files go out through send_from_directory (also behind the static URL),
+which answers with ETag and Last-Modified, 304 for a matching conditional GET
+and 206 for a Range request. With SENDFILE_MODE set the worker only sends the
+headers and the front proxy streams the bytes: "x-sendfile" (Apache, lighttpd)
+gets the absolute path, "x-accel-redirect" (nginx) gets SENDFILE_URI plus the
+path relative to the app root, which must be an internal location aliasing it.
+Blob URLs name their content, so they are cached as immutable.
+"""
+
+
+@app.after_request
+def offload(response):
+    path = response.headers.get("X-Sendfile")
+    if path is None:
+        return response
+    # the proxy serves ranges and full bodies itself from the original request
+    if response.status_code == 206:
+        response.status_code = 200
+        response.headers.pop("Content-Range", None)
+        response.content_length = os.path.getsize(path)
+    if app.config["SENDFILE_MODE"] == "x-accel-redirect":
+        del response.headers["X-Sendfile"]
+        relative = os.path.relpath(path, app.root_path).replace(os.sep, "/")
+        response.headers["X-Accel-Redirect"] = app.config["SENDFILE_URI"] + relative
+    return response
+
+
+@app.after_request
+def immutable_blobs(response):
+    if request.endpoint == "static" and response.status_code in (200, 206, 304) and \
+            (request.view_args or {}).get("filename", "").startswith(blobs.PREFIX):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    return response
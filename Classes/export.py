@@ -0,0 +1,229 @@
+import csv
+import gzip
+import io
+import os
+import zipfile
+from datetime import datetime
+from sqlalchemy import select, func, tuple_
+from init import db
+from Classes.Dbmodels import Book, Section, Requests, Feedback, ExportWatermark
+
+"""
+Streaming CSV export
+
+Rows are read with yield_per and written straight out with the csv module, so
+memory stays flat whatever the table size. The export is either one zip with a
+csv per entity or one gzipped csv per entity.
+
+Incremental exports keep a chain per entity under <directory>/<entity>/: a
+full snapshot followed by deltas holding only the rows added or changed since
+the previous run, as recorded by the entity's watermark. Every file is named
+after a sequence number claimed when it is created, so runs finishing within
+the same second can neither overwrite nor reorder each other. Compaction folds
+the deltas back into a full snapshot carrying the sequence of the last delta
+it covers.
+"""
+
+BATCH = 1000
+
+# headers, query, watermark columns (modification time then id, or just the id
+# for append-only tables, None when the entity is always exported in full)
+ENTITIES = {
+    "books": (["ID", "Book Name", "Authors", "Section Id", "User_email", "content", "issue_date", "return_date"],
+              lambda: select(Book.book_id, Book.name, Book.authors, Book.section_id, Book.user_email,
+                             Book.content, Book.issue_date, Book.return_date).order_by(Book.book_id),
+              lambda: (Book.updated_at, Book.book_id)),
+    # the book counts change without touching the section, and the table is small
+    "sections": (["ID", "Name", "Description", "Number of Books"],
+                 lambda: select(Section.section_id, Section.name, Section.description, func.count(Book.book_id)).outerjoin(
+                     Book, Book.section_id == Section.section_id).group_by(Section.section_id).order_by(Section.section_id),
+                 None),
+    "requests": (["ID", "User_email", "Book Id", "Pending Status", "Opened On", "Closed On", "Outcome"],
+                 lambda: select(Requests.request_id, Requests.user_id, Requests.book_id, Requests.pending,
+                                Requests.opened_on, Requests.closed_on, Requests.outcome).order_by(Requests.request_id),
+                 lambda: (Requests.updated_at, Requests.request_id)),
+    "feedbacks": (["ID", "Book Name", "Rating", "Feedback", "User_email", "On"],
+                  lambda: select(Feedback.feedback_id, Book.name, Feedback.rating, Feedback.feedback, Feedback.user_name,
+                                 Feedback.on).outerjoin(Book, Book.book_id == Feedback.book_id).order_by(Feedback.feedback_id),
+                  lambda: (Feedback.feedback_id,)),
+}
+
+
+def stream_rows(statement):
+    result = db.session.execute(
+        statement.execution_options(yield_per=BATCH))
+    for partition in result.partitions():
+        yield from partition
+
+
+def write_entity(entity, textfile, window=None):
+    # window is (after, upto) on the watermark columns, both ends optional
+    headers, query, columns = ENTITIES[entity]
+    statement = query()
+    if window is not None:
+        key = tuple_(*columns()) if len(columns()) > 1 else columns()[0]
+        after, upto = window
+        if after is not None:
+            statement = statement.where(key > bound(after))
+        if upto is not None:
+            statement = statement.where(key <= bound(upto))
+    writer = csv.writer(textfile)
+    writer.writerow(headers)
+    count = 0
+    for row in stream_rows(statement):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def export(directory, name, fmt="zip"):
+    # returns {entity or "zip": path}
+    os.makedirs(directory, exist_ok=True)
+    if fmt == "gzip":
+        files = {}
+        for entity in ENTITIES:
+            path = os.path.join(directory, f"{name}-{entity}.csv.gz")
+            with gzip.open(path, "wt", newline="") as textfile:
+                write_entity(entity, textfile)
+            files[entity] = path
+        return files
+    path = os.path.join(directory, f"{name}.zip")
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for entity in ENTITIES:
+            with archive.open(f"{entity}.csv", "w") as binary:
+                with io.TextIOWrapper(binary, newline="") as textfile:
+                    write_entity(entity, textfile)
+    return {"zip": path}
+
+
+def bound(values):
+    return values[0] if len(values) == 1 else tuple_(*values)
+
+
+def watermark_values(mark, columns):
+    if mark is None:
+        return None
+    return (mark.last_modified, mark.last_id) if len(columns) > 1 else (mark.last_id,)
+
+
+def current_watermark(columns):
+    # the newest row by the watermark columns, taken before streaming so rows
+    # written during the export wait for the next run
+    order = [column.desc() for column in columns]
+    return db.session.execute(select(*columns).order_by(*order).limit(1)).first()
+
+
+def position(path):
+    # (sequence, is full): a compacted snapshot shares the sequence of the last
+    # delta it covers and comes right after it
+    sequence, kind = os.path.basename(path)[:-len(".csv.gz")].split("-", 1)
+    return int(sequence), kind == "full"
+
+
+def chain_files(directory, entity):
+    # every file of the entity, oldest first
+    folder = os.path.join(directory, entity)
+    if not os.path.isdir(folder):
+        return []
+    return sorted((os.path.join(folder, name) for name in os.listdir(folder)
+                   if name.endswith(".csv.gz")), key=position)
+
+
+def chain(directory, entity):
+    # the latest full snapshot and the deltas after it
+    files = chain_files(directory, entity)
+    fulls = [i for i, path in enumerate(files) if position(path)[1]]
+    return files[fulls[-1]:] if fulls else []
+
+
+def claim_file(folder, kind):
+    # creates the next file of the chain, a concurrent run that got there
+    # first makes us move on to the following number
+    files = chain_files(os.path.dirname(folder), os.path.basename(folder))
+    sequence = position(files[-1])[0] + 1 if files else 1
+    while True:
+        path = os.path.join(folder, f"{sequence:08d}-{kind}.csv.gz")
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            sequence += 1
+
+
+def export_delta(directory, entity):
+    # returns the written file, a full snapshot when the chain has none yet
+    _, _, columns = ENTITIES[entity]
+    folder = os.path.join(directory, entity)
+    os.makedirs(folder, exist_ok=True)
+    mark = db.session.get(ExportWatermark, entity)
+    if columns is None or not chain(directory, entity):
+        kind, after = "full", None
+    else:
+        kind, after = "delta", watermark_values(mark, columns())
+    upto = current_watermark(columns()) if columns else None
+    window = None if columns is None else (after, upto)
+    path = claim_file(folder, kind)
+    with gzip.open(path, "wt", newline="") as textfile:
+        write_entity(entity, textfile, window)
+    if upto is not None:
+        mark = mark or ExportWatermark(entity=entity)
+        if len(upto) > 1:
+            mark.last_modified, mark.last_id = upto
+        else:
+            mark.last_id = upto[0]
+        mark.exported_at = datetime.now()
+        db.session.add(mark)
+        db.session.commit()
+    return path
+
+
+def export_incremental(directory):
+    return {entity: export_delta(directory, entity) for entity in ENTITIES}
+
+
+def compact_entity(directory, entity):
+    # folds the deltas into a new full snapshot and removes every file it
+    # replaces; deltas written meanwhile come after it and are kept
+    files = chain(directory, entity)
+    if not files:
+        return None
+    target = files[-1] if len(files) == 1 else merge(entity, files)
+    for path in chain_files(directory, entity):
+        if position(path) < position(target):
+            os.remove(path)
+    return target
+
+
+def merge(entity, files):
+    # the snapshot with each row replaced by its latest delta version, rows no
+    # longer in the database dropped and new rows appended in id order
+    headers, query, _ = ENTITIES[entity]
+    changed = {}
+    for path in files[1:]:
+        with gzip.open(path, "rt", newline="") as textfile:
+            rows = csv.reader(textfile)
+            next(rows)
+            for row in rows:
+                changed[row[0]] = row
+    id_column = query().selected_columns[0]
+    live = {str(row[0]) for row in stream_rows(select(id_column))}
+    target = files[-1].replace("-delta.csv.gz", "-full.csv.gz")
+    partial = target + ".part"
+    with gzip.open(partial, "wt", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(headers)
+        with gzip.open(files[0], "rt", newline="") as textfile:
+            rows = csv.reader(textfile)
+            next(rows)
+            for row in rows:
+                if row[0] in live:
+                    writer.writerow(changed.pop(row[0], row))
+        for row_id in sorted(changed, key=int):
+            if row_id in live:
+                writer.writerow(changed[row_id])
+    os.replace(partial, target)
+    return target
+
+
+def compact(directory):
+    return {entity: compact_entity(directory, entity) for entity in ENTITIES}
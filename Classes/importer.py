@@ -0,0 +1,113 @@
+import csv
+import json
+from sqlalchemy.exc import SQLAlchemyError
+from init import app, db
+from Classes.Dbmodels import Book, Section
+from Classes import invalidation
+
+"""
+Bulk book import
+
+Books come as CSV (header row with name, authors, content, section_id) or as
+JSON Lines of objects with the same keys. Section ids are checked against one
+query up front, valid rows are inserted with executemany in one transaction
+per IMPORT_CHUNK rows, and the caches are invalidated once at the end. Bad
+rows, including rows that are not valid UTF-8, are skipped and reported by
+line number. No PDFs are rendered for imported books.
+"""
+
+def undecodable(row):
+    # the file is read with errors="surrogateescape", bad bytes end up as
+    # lone surrogates instead of aborting the whole import
+    try:
+        json.dumps(row, ensure_ascii=False).encode("utf-8")
+        return False
+    except UnicodeEncodeError:
+        return True
+
+
+def read_rows(textfile, fmt):
+    # yields (line, dict or None, error)
+    if fmt == "csv":
+        reader = csv.DictReader(textfile)
+        for row in reader:
+            if undecodable(row):
+                yield reader.line_num, None, "not valid UTF-8"
+                continue
+            yield reader.line_num, row, None
+        return
+    for line, text in enumerate(textfile, start=1):
+        if not text.strip():
+            continue
+        if undecodable(text):
+            yield line, None, "not valid UTF-8"
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as e:
+            yield line, None, f"invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield line, None, "expected an object"
+            continue
+        yield line, row, None
+
+
+def clean(row, sections):
+    # returns (values, error)
+    name = str(row.get("name") or "").strip()
+    authors = str(row.get("authors") or "").strip()
+    if not name:
+        return None, "name is required"
+    if not authors:
+        return None, "authors is required"
+    section_id = row.get("section_id")
+    try:
+        section_id = int(section_id) if section_id not in (None, "") else 0
+    except (TypeError, ValueError):
+        return None, f"section_id {section_id!r} is not a number"
+    if section_id not in sections:
+        return None, f"section {section_id} does not exist"
+    return dict(name=name, authors=authors, section_id=section_id,
+                content=str(row.get("content") or "")), None
+
+
+def insert_chunk(rows, lines, errors):
+    # one executemany and one commit, a failing chunk is reported row by row
+    try:
+        db.session.execute(Book.__table__.insert(), rows)
+        db.session.commit()
+        return len(rows)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        errors += [dict(line=line, error=str(getattr(e, "orig", None) or e))
+                   for line in lines]
+        return 0
+
+
+def import_books(textfile, fmt="csv", chunk=None):
+    # returns the number of inserted books and the rejected rows
+    chunk = chunk or app.config["IMPORT_CHUNK"]
+    sections = {section_id for section_id, in db.session.query(Section.section_id)}
+    inserted, errors, rows, lines = 0, [], [], []
+    try:
+        for line, row, error in read_rows(textfile, fmt):
+            values = None
+            if error is None:
+                values, error = clean(row, sections)
+            if error is not None:
+                errors.append(dict(line=line, error=error))
+                continue
+            rows.append(values)
+            lines.append(line)
+            if len(rows) == chunk:
+                inserted += insert_chunk(rows, lines, errors)
+                rows, lines = [], []
+        if rows:
+            inserted += insert_chunk(rows, lines, errors)
+    finally:
+        # committed chunks stay, even when the stream breaks off
+        if inserted:
+            invalidation.catalog_changed()
+    limit = app.config["IMPORT_MAX_ERRORS"]
+    return dict(inserted=inserted, rejected=len(errors), errors=errors[:limit])
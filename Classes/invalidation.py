@@ -0,0 +1,51 @@
+from init import cache
+
+"""
+Generation based cache invalidation
+
+Cached views are keyed by the generations of the entities they depend on
+(catalog, book:<id>, user:<email>, books for any change to what a book
+shows). Bumping a generation makes every key built
+from the old one unreachable, the stale entries expire on their own.
+"""
+
+TIMEOUT = 3600
+
+
+def generations(*tags):
+    values = cache.get_many(*[f"gen:{tag}" for tag in tags])
+    return [value or 0 for value in values]
+
+
+def tagged_key(name, *tags):
+    return name + "@" + ",".join(str(gen) for gen in generations(*tags))
+
+
+def bump(*tags):
+    for tag in set(tags):
+        cache.cache.inc(f"gen:{tag}")
+
+
+def remember(key, compute, timeout=TIMEOUT):
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout=timeout)
+    return value
+
+
+def catalog_changed():
+    # book list, ordering or section layout changed
+    bump("catalog", "books", "stats")
+
+
+def book_changed(*book_ids):
+    bump("books", "stats", *[f"book:{int(book_id)}" for book_id in book_ids])
+
+
+def requests_changed():
+    bump("stats")
+
+
+def user_changed(*emails):
+    bump(*[f"user:{email}" for email in emails if email])
@@ -0,0 +1,62 @@
+import smtplib
+import time
+from init import app
+
+"""
+SMTP transport
+
+One authenticated connection is reused for every message sent through a
+Mailer. A failed send drops the connection, waits with exponential backoff,
+reconnects and retries the same message.
+"""
+
+
+class Mailer:
+    def __init__(self, user, password, host=None, port=None, use_ssl=None, retries=None, backoff=None):
+        self.user = user
+        self.password = password
+        self.host = host or app.config["MAIL_HOST"]
+        self.port = port or app.config["MAIL_PORT"]
+        self.use_ssl = app.config["MAIL_USE_SSL"] if use_ssl is None else use_ssl
+        self.retries = app.config["MAIL_RETRIES"] if retries is None else retries
+        self.backoff = app.config["MAIL_BACKOFF"] if backoff is None else backoff
+        self.smtp = None
+
+    def connect(self):
+        if self.use_ssl:
+            self.smtp = smtplib.SMTP_SSL(self.host, self.port)
+        else:
+            self.smtp = smtplib.SMTP(self.host, self.port)
+        if self.password:
+            self.smtp.login(self.user, self.password)
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.smtp = None
+
+    def send(self, msg):
+        for attempt in range(self.retries + 1):
+            try:
+                if self.smtp is None:
+                    self.connect()
+                self.smtp.send_message(msg)
+                return
+            except smtplib.SMTPRecipientsRefused:
+                # permanent, retrying will not help
+                raise
+            except (smtplib.SMTPException, OSError):
+                self.close()
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
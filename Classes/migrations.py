@@ -0,0 +1,174 @@
+import os
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+from init import app, db
+from Classes.Dbmodels import Book, Section, Feedback, Requests, Owner, Read, VisitHistory, ExportWatermark, Blob
+from Classes import blobs, search
+
+"""
+Versioned schema migrations
+
+The schema version is kept in SQLite's PRAGMA user_version. A fresh database
+is created from the models and stamped with the latest version, an existing
+one is brought up to date by running every pending migration in order.
+"""
+
+
+def get_version():
+    return db.session.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_version(version):
+    db.session.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def columns_of(table):
+    return [row[1] for row in db.session.execute(text(f'PRAGMA table_info("{table}")'))]
+
+
+def add_column(table, definition):
+    name = definition.split()[0]
+    if name not in columns_of(table):
+        db.session.execute(
+            text(f'ALTER TABLE "{table}" ADD COLUMN {definition}'))
+
+
+def create_indexes(*models):
+    # indexes on columns a later migration adds are left to that migration
+    for model in models:
+        existing = columns_of(model.__tablename__)
+        for index in model.__table__.indexes:
+            if all(column.name in existing for column in index.columns):
+                index.create(db.session.connection(), checkfirst=True)
+
+
+def rebuild_table(model):
+    # SQLite cannot change a column type in place: copy into a table built
+    # from the model, casting along the way, and swap it in
+    table = model.__table__
+    name = table.name
+    old_columns = columns_of(name)
+    ddl = str(CreateTable(table).compile(dialect=db.engine.dialect)).replace(
+        f'CREATE TABLE "{name}"', f'CREATE TABLE "{name}_new"', 1)
+    # pysqlite runs DDL outside the migration's transaction, so a failed
+    # earlier attempt can have left the copy behind
+    db.session.execute(text(f'DROP TABLE IF EXISTS "{name}_new"'))
+    db.session.execute(text(ddl))
+    copied = [column for column in table.columns if column.name in old_columns]
+    targets = ", ".join(f'"{column.name}"' for column in copied)
+    sources = ", ".join(f'CAST("{column.name}" AS INTEGER)' if isinstance(column.type, db.Integer)
+                        else f'"{column.name}"' for column in copied)
+    db.session.execute(
+        text(f'INSERT INTO "{name}_new" ({targets}) SELECT {sources} FROM "{name}"'))
+    db.session.execute(text(f'DROP TABLE "{name}"'))
+    db.session.execute(
+        text(f'ALTER TABLE "{name}_new" RENAME TO "{name}"'))
+    create_indexes(model)
+
+
+def rating_aggregates():
+    add_column("Book", "rating_sum INTEGER NOT NULL DEFAULT 0")
+    add_column("Book", "rating_count INTEGER NOT NULL DEFAULT 0")
+    add_column("Book", "rating FLOAT NOT NULL DEFAULT 0")
+    # plain SQL, the ORM would also touch columns added by later migrations
+    db.session.execute(text("""UPDATE "Book" SET
+        rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM "Feedback" WHERE "Feedback".book_id = "Book".book_id),
+        rating_count = (SELECT COUNT(*) FROM "Feedback" WHERE "Feedback".book_id = "Book".book_id),
+        rating = (SELECT COALESCE(AVG(rating), 0) FROM "Feedback" WHERE "Feedback".book_id = "Book".book_id)"""))
+
+
+def search_index():
+    search.rebuild_index()
+
+
+def integer_keys_and_indexes():
+    for model in (Feedback, Requests, Owner, Read):
+        rebuild_table(model)
+    # the VisitHistory index is the unique one of migration 6, which first
+    # removes duplicates
+    create_indexes(Book)
+
+
+def book_pdf_status():
+    add_column("Book", "pdf_status VARCHAR")
+    db.session.execute(
+        text("""UPDATE "Book" SET pdf_status = 'ready' WHERE file_name IS NOT NULL"""))
+
+
+def export_watermarks():
+    for model in (Book, Section, Requests):
+        add_column(model.__tablename__, "updated_at DATETIME")
+        model.query.filter(model.updated_at == None).update(
+            {model.updated_at: datetime.now()}, synchronize_session=False)
+        create_indexes(model)
+    ExportWatermark.__table__.create(db.session.connection(), checkfirst=True)
+
+
+def unique_visits():
+    db.session.execute(text("""DELETE FROM "VisitHistory" WHERE id NOT IN
+        (SELECT MIN(id) FROM "VisitHistory" GROUP BY user_id, "on")"""))
+    db.session.execute(text('DROP INDEX IF EXISTS "ix_VisitHistory_user_id_on"'))
+    create_indexes(VisitHistory)
+
+
+def blob_store():
+    # moves every book file into the blob store, identical files become one
+    # plain SQL on Book, the model has columns later migrations add
+    Blob.__table__.create(db.session.connection(), checkfirst=True)
+    moved = {}
+    books = db.session.execute(
+        text('SELECT book_id, file_name FROM "Book" WHERE file_name IS NOT NULL')).all()
+    for book_id, file_name in books:
+        if blobs.digest_of(file_name):
+            continue
+        path = os.path.join(app.config["UPLOAD_FOLDER"], file_name)
+        if file_name not in moved:
+            if not os.path.exists(path):
+                continue
+            moved[file_name] = blobs.store_file(path)
+        blobs.acquire(moved[file_name])
+        db.session.execute(text('UPDATE "Book" SET file_name = :file_name WHERE book_id = :book_id'),
+                           dict(file_name=moved[file_name], book_id=book_id))
+        db.session.flush()
+
+
+def pdf_render_tokens():
+    add_column("Book", "pdf_render INTEGER NOT NULL DEFAULT 0")
+
+
+MIGRATIONS = [
+    (1, "rating aggregates on Book", rating_aggregates),
+    (2, "FTS5 search index", search_index),
+    (3, "integer book foreign keys and indexes", integer_keys_and_indexes),
+    (4, "pdf generation status on Book", book_pdf_status),
+    (5, "modification times and export watermarks", export_watermarks),
+    (6, "one VisitHistory row per user and day", unique_visits),
+    (7, "content addressed book files", blob_store),
+    (8, "render tokens on Book", pdf_render_tokens),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def create():
+    db.create_all()
+    search.rebuild_index()
+    set_version(LATEST)
+    db.session.commit()
+
+
+def upgrade():
+    version = get_version()
+    for number, description, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        print(f"migrating to {number}: {description}")
+        try:
+            migrate()
+            set_version(number)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return get_version()
@@ -0,0 +1,81 @@
+import base64
+import binascii
+import json
+from functools import wraps
+from flask import request, jsonify
+from sqlalchemy import tuple_
+
+"""
+Keyset pagination
+
+List endpoints take ?limit=&after=<cursor> and answer with
+{"items": [...], "next_cursor": ...}. The cursor is the sort key of the last
+row, so a page costs the same wherever it is in the table.
+?paginate=false returns the old unpaginated list.
+"""
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values
+
+
+def paginated(fun):
+    @wraps(fun)
+    def _paginate(*args, **kwargs):
+        if request.args.get("paginate", "true").lower() == "false":
+            return fun(*args, page=None, **kwargs)
+        try:
+            limit = min(
+                int(request.args.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+            after = request.args.get("after")
+            after = decode_cursor(after) if after else None
+        except ValueError:
+            return jsonify({"error": "invalid limit or cursor"}), 400
+        if limit < 1:
+            return jsonify({"error": "invalid limit or cursor"}), 400
+        try:
+            return fun(*args, page=(after, limit), **kwargs)
+        except InvalidCursor:
+            return jsonify({"error": "invalid limit or cursor"}), 400
+    return _paginate
+
+
+def keyset(query, columns, after=None, limit=DEFAULT_LIMIT, descending=False, entity=None):
+    # the last column must be unique so the order is total, entity picks the
+    # object holding the sort key out of a multi-entity row
+    if after is not None:
+        if len(after) != len(columns):
+            raise InvalidCursor(after)
+        key, bound = (columns[0], after[0]) if len(columns) == 1 \
+            else (tuple_(*columns), tuple_(*after))
+        query = query.filter(key < bound if descending else key > bound)
+    order = [column.desc() if descending else column for column in columns]
+    rows = query.order_by(*order).limit(limit+1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = entity(rows[-1]) if entity else rows[-1]
+        next_cursor = encode_cursor(
+            [getattr(last, column.key) for column in columns])
+    return rows, next_cursor
+
+
+def page(items, next_cursor):
+    return {"items": items, "next_cursor": next_cursor}
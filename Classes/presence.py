@@ -0,0 +1,49 @@
+import time
+from init import app, redis_client as client
+from Classes.pagination import encode_cursor, InvalidCursor
+
+"""
+Online users
+
+Presence lives in one Redis sorted set, member = email and score = time of the
+last heartbeat, so every process sees the same view and an update is a single
+O(log n) ZADD. Login and authenticated requests beat, logout leaves, anyone
+silent for PRESENCE_TTL seconds drops out on the next read.
+"""
+
+KEY = "presence:users"
+
+
+def heartbeat(email):
+    client.zadd(KEY, {email: time.time()})
+
+
+def leave(email):
+    client.zrem(KEY, email)
+
+
+def prune():
+    client.zremrangebyscore(KEY, "-inf", time.time() - app.config["PRESENCE_TTL"])
+
+
+def active(after=None, limit=None):
+    # emails, most recently seen first, and the cursor of the next page; after
+    # is the [score, email] of the last row of the previous page
+    prune()
+    top, ties = "+inf", 0
+    if after is not None:
+        if len(after) != 2 or not isinstance(after[0], (int, float)):
+            raise InvalidCursor(after)
+        top, email = after
+        # equal scores come in reverse member order, skip the ones already seen
+        ties = client.zcount(KEY, top, top)
+    window = dict(start=0, num=limit + 1 + ties) if limit else {}
+    rows = client.zrevrangebyscore(KEY, top, "-inf", withscores=True, **window)
+    if after is not None:
+        rows = [(member, seen) for member, seen in rows
+                if seen < top or member < email]
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][1], rows[-1][0]])
+    return [member for member, _ in rows], next_cursor
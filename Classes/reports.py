@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+from init import app, cache
+from Classes import invalidation
+
+"""
+Report de-duplication
+
+A report is keyed by its kind, its parameters and the data version it was
+built from. Each run gets a fresh celery task id, kept with the in-flight
+claim on the key, so a later run never inherits an old run's result.
+Triggering a report that is already running hands back the running task,
+triggering one that finished recently hands back its files. Generated files live in a content
+addressed store (protected/artifacts/<sha256>), so identical output is kept
+once and rendering the same PDF twice is skipped.
+"""
+
+INFLIGHT_TIMEOUT = 3600
+ARTIFACT_TIMEOUT = 24 * 3600
+
+
+def data_version():
+    # bumped whenever a book, section, request or feedback changes
+    return invalidation.generations("stats")[0]
+
+
+def report_key(kind, params, version=None):
+    version = data_version() if version is None else version
+    blob = json.dumps([kind, params, version], sort_keys=True, default=str)
+    return f"{kind}-{hashlib.sha256(blob.encode()).hexdigest()[:32]}"
+
+
+def claim(key, run_id=True):
+    # only the first caller gets True until the key is released
+    return cache.add(f"report:inflight:{key}", run_id, timeout=INFLIGHT_TIMEOUT)
+
+
+def release(key):
+    cache.delete(f"report:inflight:{key}")
+
+
+def running(key):
+    # the id the claim was taken with, None when nothing runs
+    return cache.get(f"report:inflight:{key}")
+
+
+def last_run(key):
+    return cache.get(f"report:run:{key}")
+
+
+def remember_run(key, run_id):
+    cache.set(f"report:run:{key}", run_id, timeout=ARTIFACT_TIMEOUT)
+
+
+def recorded(key):
+    # the files a recent run wrote, whether or not they still exist
+    return cache.get(f"report:done:{key}")
+
+
+def finished(key):
+    # the files of a recent run, as long as they are all still in the store
+    files = recorded(key)
+    if files and all(os.path.exists(path) for path in files.values()):
+        return files
+    return None
+
+
+def remember(key, files):
+    cache.set(f"report:done:{key}", files, timeout=ARTIFACT_TIMEOUT)
+
+
+def suffix(path):
+    return ".csv.gz" if path.endswith(".csv.gz") else os.path.splitext(path)[1]
+
+
+def store(path):
+    # moves a finished file into the store under the hash of its content
+    digest = hashlib.sha256()
+    with open(path, "rb") as artifact:
+        for chunk in iter(lambda: artifact.read(1 << 20), b""):
+            digest.update(chunk)
+    directory = os.path.join(app.config["PRO_UPLOAD_FOLDER"], "artifacts")
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, digest.hexdigest() + suffix(path))
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.replace(path, target)
+    return target
+
+
+def download_name(entity, path):
+    return ("report" if entity == "zip" else entity) + suffix(path)
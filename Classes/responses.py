@@ -0,0 +1,83 @@
+import gzip
+import hashlib
+import json
+from functools import wraps
+from flask import request, make_response
+from init import app, cache
+from Classes.invalidation import TIMEOUT, generations
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+"""
+Conditional, compressed JSON
+
+versioned() tags a list endpoint with the generations its body depends on.
+The ETag is a hash of the path, the query string and those generations, so it
+is known from the cache alone: a matching If-None-Match is a 304 without
+touching the database. Bodies of COMPRESS_MIN_SIZE bytes or more are sent
+brotli or gzip compressed, whichever the client prefers, each encoding with
+its own ETag. Only views that are the same for everyone (no per-principal
+tag) keep the built body in the cache; per-user views are rebuilt from the
+shared catalog cache, storing them would mean a catalog copy per user.
+"""
+
+
+def encodings():
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+def versioned(*tags):
+    # tags are generation names, or callables taking the principal
+    def decorator(fun):
+        @wraps(fun)
+        def _versioned(principal, *args, **kwargs):
+            names = [tag(principal) if callable(tag) else tag for tag in tags]
+            shared = not any(callable(tag) for tag in tags)
+            base = hashlib.sha256(json.dumps([request.path, sorted(request.args.items(multi=True)), names,
+                                              generations(*names)]).encode()).hexdigest()[:32]
+            encoding = request.accept_encodings.best_match(encodings())
+            etag = f"{base}-{encoding}" if encoding else base
+            for known in (etag, base):
+                # small bodies only exist uncompressed, under the base tag
+                if request.if_none_match.contains(known):
+                    return respond(b"", known, None, 304)
+            stored = shared and (cache.get(f"response:{etag}") or cache.get(
+                f"response:{base}"))
+            if stored:
+                body, body_encoding = stored
+                return respond(body, etag if body_encoding else base, body_encoding)
+            response = make_response(fun(principal, *args, **kwargs))
+            if response.status_code != 200 or not response.is_json:
+                return response
+            body = response.get_data()
+            if encoding is None or len(body) < app.config["COMPRESS_MIN_SIZE"]:
+                encoding, etag = None, base
+            else:
+                body = compress(body, encoding)
+            if shared:
+                cache.set(f"response:{etag}", (body, encoding), timeout=TIMEOUT)
+            return respond(body, etag, encoding)
+        return _versioned
+    return decorator
+
+
+def respond(body, etag, encoding, status=200):
+    response = make_response(body, status)
+    response.mimetype = "application/json"
+    response.set_etag(etag)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.update(("Accept-Encoding", "Authorization"))
+    # always revalidate, the 304 is cheap
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,124 @@
+import re
+from sqlalchemy import table, column, text, or_
+from sqlalchemy.exc import OperationalError
+from init import db
+from Classes.Dbmodels import Book, Section
+
+"""
+Full text search
+
+book_fts and section_fts are external content FTS5 tables over Book and
+Section, kept in sync by triggers. Search falls back to LIKE when the SQLite
+build has no FTS5 or the index has not been created yet.
+"""
+
+book_fts = table("book_fts", column("rowid"), column("rank"))
+section_fts = table("section_fts", column("rowid"), column("rank"))
+
+INDEXES = {
+    "book_fts": ("Book", "book_id", ["name", "authors", "content"]),
+    "section_fts": ("Section", "section_id", ["name", "description"]),
+}
+
+
+def index_schema(name, source, key, columns):
+    cols = ", ".join(columns)
+    new = ", ".join(f"new.{col}" for col in columns)
+    old = ", ".join(f"old.{col}" for col in columns)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({cols}, content='{source}', content_rowid='{key}')",
+        f"""CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON "{source}" BEGIN
+            INSERT INTO {name}(rowid, {cols}) VALUES (new.{key}, {new}); END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON "{source}" BEGIN
+            INSERT INTO {name}({name}, rowid, {cols}) VALUES ('delete', old.{key}, {old}); END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {name}_au AFTER UPDATE OF {cols} ON "{source}" BEGIN
+            INSERT INTO {name}({name}, rowid, {cols}) VALUES ('delete', old.{key}, {old});
+            INSERT INTO {name}(rowid, {cols}) VALUES (new.{key}, {new}); END""",
+    ]
+
+
+def fts_enabled():
+    found = db.session.execute(text(
+        "SELECT count(*) FROM sqlite_master WHERE name IN ('book_fts', 'section_fts')")).scalar()
+    return found == len(INDEXES)
+
+
+def rebuild_index():
+    # creates missing tables and triggers, then repopulates from the source tables
+    try:
+        for name, (source, key, columns) in INDEXES.items():
+            for statement in index_schema(name, source, key, columns):
+                db.session.execute(text(statement))
+            db.session.execute(
+                text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+        db.session.commit()
+    except OperationalError as e:
+        # SQLite built without FTS5
+        db.session.rollback()
+        print(e)
+        return False
+    return True
+
+
+def ensure_index():
+    if fts_enabled():
+        return True
+    return rebuild_index()
+
+
+def match_expression(key, columns):
+    # every word is a prefix match so results show up while typing
+    terms = re.findall(r"\w+", key or "")
+    if not terms:
+        return None
+    return "{%s} : (%s)" % (" ".join(columns), " ".join(f'"{term}"*' for term in terms))
+
+
+def like_filter(model, key, columns):
+    search_key = '%'+key+'%'
+    return or_(*[getattr(model, col).like(search_key) for col in columns])
+
+
+def search_books(key, columns, query=None, limit=None):
+    query = query if query is not None else Book.query
+    expression = match_expression(key, columns)
+    if expression is None and key:
+        # only punctuation, nothing can match
+        return []
+    if expression is None:
+        query = query.order_by(Book.rating.desc(), Book.book_id.desc())
+    elif fts_enabled():
+        query = query.join(book_fts, book_fts.c.rowid == Book.book_id).filter(
+            text("book_fts MATCH :expression").bindparams(expression=expression)).order_by(book_fts.c.rank)
+    else:
+        query = query.filter(like_filter(Book, key, columns)).order_by(
+            Book.rating.desc(), Book.book_id.desc())
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def search_sections(key, limit=None):
+    columns = ["name", "description"]
+    query = Section.query
+    expression = match_expression(key, columns)
+    if expression is None and key:
+        return []
+    if expression is None:
+        query = query.order_by(Section.section_id)
+    elif fts_enabled():
+        query = query.join(section_fts, section_fts.c.rowid == Section.section_id).filter(
+            text("section_fts MATCH :expression").bindparams(expression=expression)).order_by(section_fts.c.rank)
+    else:
+        query = query.filter(like_filter(Section, key, columns))
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def book_columns(index):
+    if index == '1':
+        return ["name"]
+    if index == '4':
+        return ["name", "authors", "content"]
+    return ["authors"]
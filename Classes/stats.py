@@ -0,0 +1,35 @@
+from sqlalchemy import select, func, case, true
+from init import db
+from Classes.Dbmodels import Book, Section, Requests
+from Classes.invalidation import tagged_key, remember
+
+"""
+Librarian dashboard numbers
+
+Every count comes out of a single SELECT, cached until a book, section or
+request changes (the "stats" generation).
+"""
+
+
+def count_where(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+def compute():
+    requests = select(func.count().label("requests"), count_where(Requests.outcome == "accepted").label("accepted"),
+                      count_where(Requests.outcome == "rejected").label("rejected"),
+                      count_where(Requests.pending == True).label("pending")).select_from(Requests).subquery()
+    books = select(func.count().label("books"), count_where(
+        Book.user_email != None).label("in_use")).select_from(Book).subquery()
+    sections = select(func.count()).select_from(
+        Section).scalar_subquery().label("sections")
+    # both subqueries are a single row, the join just puts them side by side
+    row = db.session.execute(select(requests, books, sections).select_from(
+        requests.join(books, true()))).one()
+    total, accepted, rejected, pending, book_count, in_use, section_count = row
+    return dict(requests=total, arequests=accepted, rrequests=rejected, prequests=pending,
+                books=book_count, sections=section_count, books_in_use=in_use, books_available=book_count-in_use)
+
+
+def dashboard():
+    return remember(tagged_key("stats", "stats"), compute)
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import time
+import uuid
+from init import app, cache
+from Classes import blobs
+
+"""
+Resumable uploads
+
+A librarian opens a session with the size and sha256 of the file, PUTs the
+bytes in chunks at increasing offsets and finalizes. Chunks are streamed
+straight from the request into protected/uploads/<id>.part, so memory stays
+bounded whatever the file size. The file on disk is the source of truth for
+the offset: after a dropped connection the client asks for it and carries on
+from there. Finalizing checks size and checksum and moves the file into the
+blob store, ready to be attached to a book.
+"""
+
+CHUNK = 1 << 16
+
+
+class UploadError(ValueError):
+    def __init__(self, message, status=409):
+        super().__init__(message)
+        self.status = status
+
+
+def folder():
+    return os.path.join(app.config["PRO_UPLOAD_FOLDER"], "uploads")
+
+
+def part_path(upload_id):
+    return os.path.join(folder(), upload_id + ".part")
+
+
+def start(size, sha256):
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError("size must be a positive integer", 400)
+    if not isinstance(sha256, str) or len(sha256) != 64:
+        raise UploadError("sha256 must be a hex digest", 400)
+    os.makedirs(folder(), exist_ok=True)
+    session = dict(id=uuid.uuid4().hex, size=size, sha256=sha256.lower())
+    open(part_path(session["id"]), "wb").close()
+    cache.set(f"upload:{session['id']}", session,
+              timeout=app.config["UPLOAD_SESSION_TTL"])
+    return status(session)
+
+
+def get(upload_id):
+    session = cache.get(f"upload:{upload_id}")
+    if session is None or not os.path.exists(part_path(upload_id)):
+        return None
+    return session
+
+
+def status(session):
+    return dict(upload_id=session["id"], size=session["size"], offset=os.path.getsize(part_path(session["id"])),
+                chunk_size=app.config["UPLOAD_CHUNK_SIZE"])
+
+
+def write(session, offset, stream, length):
+    # appends one chunk; offset must be where the file ends, so a retried or
+    # out of order chunk is refused with the offset to resume from
+    if length is None or length > app.config["UPLOAD_CHUNK_SIZE"]:
+        raise UploadError(
+            f"chunks need a Content-Length of at most {app.config['UPLOAD_CHUNK_SIZE']}", 413)
+    lock = f"upload:lock:{session['id']}"
+    if not cache.add(lock, True, timeout=600):
+        raise UploadError("another chunk is being written")
+    try:
+        path = part_path(session["id"])
+        current = os.path.getsize(path)
+        if offset != current:
+            raise UploadError(f"expected offset {current}")
+        if current + length > session["size"]:
+            raise UploadError("chunk goes past the declared size", 400)
+        with open(path, "ab") as part:
+            remaining = length
+            while remaining:
+                chunk = stream.read(min(CHUNK, remaining))
+                if not chunk:
+                    break
+                part.write(chunk)
+                remaining -= len(chunk)
+        return status(session)
+    finally:
+        cache.delete(lock)
+
+
+def finish(session):
+    # verifies the upload and moves it into the blob store; returns the file_name
+    path = part_path(session["id"])
+    if os.path.getsize(path) != session["size"]:
+        raise UploadError("upload is incomplete")
+    digest = hashlib.sha256()
+    with open(path, "rb") as part:
+        for chunk in iter(lambda: part.read(CHUNK), b""):
+            digest.update(chunk)
+    if digest.hexdigest() != session["sha256"]:
+        abort(session["id"])
+        raise UploadError("checksum mismatch, upload discarded", 422)
+    cache.delete(f"upload:{session['id']}")
+    return blobs.place(path, session["sha256"])
+
+
+def abort(upload_id):
+    cache.delete(f"upload:{upload_id}")
+    if os.path.exists(part_path(upload_id)):
+        os.remove(part_path(upload_id))
+
+
+def expire():
+    # removes parts of sessions nobody touched within the session lifetime
+    if not os.path.isdir(folder()):
+        return 0
+    cutoff = time.time() - app.config["UPLOAD_SESSION_TTL"]
+    removed = 0
+    for name in os.listdir(folder()):
+        path = os.path.join(folder(), name)
+        if name.endswith(".part") and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    return removed
@@ -0,0 +1,54 @@
+import uuid
+from datetime import date
+from redis.exceptions import ResponseError
+from sqlalchemy.dialects.sqlite import insert
+from init import db, redis_client
+from Classes.Dbmodels import VisitHistory
+
+"""
+Visit recording
+
+A visit is a (user, day) pair. Logins only add the pair to a Redis set, which
+is idempotent and costs no database transaction; flush() moves the set into
+VisitHistory in batches with INSERT OR IGNORE against the unique
+(user_id, on) index. The set is renamed away before reading, so visits that
+arrive during a flush wait for the next one, and a failed flush puts its
+pairs back.
+"""
+
+PENDING = "visits:pending"
+
+
+def record(email, day=None):
+    redis_client.sadd(PENDING, f"{(day or date.today()).isoformat()}|{email}")
+
+
+def flush(batch=500):
+    flushing = f"visits:flushing:{uuid.uuid4()}"
+    try:
+        redis_client.rename(PENDING, flushing)
+    except ResponseError:
+        # no such key, nothing is pending
+        return 0
+    statement = insert(VisitHistory).on_conflict_do_nothing(
+        index_elements=["user_id", "on"])
+    count = 0
+    try:
+        rows = []
+        for member in redis_client.sscan_iter(flushing, count=batch):
+            day, email = member.split("|", 1)
+            rows.append(dict(user_id=email, on=date.fromisoformat(day)))
+            if len(rows) == batch:
+                db.session.execute(statement, rows)
+                count, rows = count + len(rows), []
+        if rows:
+            db.session.execute(statement, rows)
+            count += len(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        redis_client.sunionstore(PENDING, [PENDING, flushing])
+        raise
+    finally:
+        redis_client.delete(flushing)
+    return count
@@ -1,10 +1,12 @@
 from flask import render_template
 from Classes.Dbmodels import *
-from init import app, celery
+from init import app, celery, cache
 from routes.user import *
 from routes.librarian import *
 from Classes.api import *
+from Classes import delivery, importer, search, migrations
 from celery.schedules import crontab
+import click
 
 celery.conf.beat_schedule = {
     'daily_remainder': {
@@ -14,6 +16,14 @@ celery.conf.beat_schedule = {
     'monthly_report': {
         'task': 'send_monthly_report_task',
         'schedule': crontab(day_of_month='28-31', hour=23, minute=0)
+    },
+    'flush_visits': {
+        'task': 'flush_visits_task',
+        'schedule': app.config['VISIT_FLUSH_SECONDS']
+    },
+    'collect_blobs': {
+        'task': 'collect_blobs_task',
+        'schedule': crontab(minute=15)  # hourly
     }
 }
 
@@ -25,9 +35,35 @@ def index():
     return render_template("index.html")
 
 
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index():
+    if search.rebuild_index():
+        print("search index rebuilt")
+    else:
+        print("FTS5 unavailable, search falls back to LIKE")
+
+
+@app.cli.command("import-books")
+@click.argument("path")
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="defaults to the file extension")
+def import_books_command(path, fmt):
+    fmt = fmt or ("jsonl" if path.endswith((".jsonl", ".json")) else "csv")
+    with open(path, encoding="utf-8-sig", errors="surrogateescape", newline="") as textfile:
+        report = importer.import_books(textfile, fmt)
+    print(f"{report['inserted']} books imported, {report['rejected']} rows rejected")
+    for error in report["errors"]:
+        print(f"line {error['line']}: {error['error']}")
+
+
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    print(f"schema at version {migrations.upgrade()}")
+
+
 if __name__ == "__main__":
     if not os.path.exists("instance/library_database.sqlite3"):
-        db.create_all()
+        migrations.create()
         cache.clear()
         librarian = Librarian(
             user_name=os.environ["LIBRARIAN_USERNAME"], mail=os.environ["EMAIL"])
@@ -37,4 +73,5 @@ if __name__ == "__main__":
         db.session.add(librarian)
         db.session.add(section)
         db.session.commit()
+    migrations.upgrade()
     app.run(host='0.0.0.0', port='5000', debug=True)
@@ -1,12 +1,15 @@
+import os
+from dotenv import load_dotenv
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Api
 from celery import Celery, Task
 from flask_cors import CORS
 from flask_caching import Cache
+import redis
 # from flask_socketio import SocketIO, emit
 
-online_users = set()
+load_dotenv()
 
 db = SQLAlchemy()
 app = Flask(__name__)
@@ -24,12 +27,43 @@ app.config['CACHE_TYPE'] = 'RedisCache'
 app.config['CACHE_REDIS_HOST'] = 'localhost'
 app.config['CACHE_REDIS_PORT'] = 6379
 app.config['CACHE_REDIS_DB'] = 0
+app.config['MAIL_HOST'] = os.environ.get('MAIL_HOST', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 465))
+app.config['MAIL_USE_SSL'] = os.environ.get('MAIL_USE_SSL', 'true') == 'true'
+app.config['MAIL_RETRIES'] = 3
+app.config['MAIL_BACKOFF'] = 1  # seconds, doubled on every retry
+# send return reminders this many days before the due date
+app.config['RETURN_REMINDER_DAYS'] = 0
+# daily reminders go out in batches of this many recipients, each batch a task
+app.config['REMINDER_BATCH_SIZE'] = 200
+app.config['REMINDER_RATE_LIMIT'] = "30/m"  # batches per worker
+app.config['REPORT_WORKERS'] = 4  # parallel wkhtmltopdf renders for monthly reports
+app.config['AUTH_CACHE_SIZE'] = 1024  # token subjects kept per process
+app.config['AUTH_CACHE_TTL'] = 30  # seconds before an account is read again
+app.config['PRESENCE_TTL'] = 300  # seconds without a request before a user is offline
+app.config['VISIT_FLUSH_SECONDS'] = 60  # buffered visits are written this often
+# None serves files from the worker, "x-sendfile" or "x-accel-redirect" hands
+# them to the front proxy
+app.config['SENDFILE_MODE'] = os.environ.get('SENDFILE_MODE') or None
+app.config['SENDFILE_URI'] = os.environ.get('SENDFILE_URI', '/_files/')
+app.config['USE_X_SENDFILE'] = app.config['SENDFILE_MODE'] is not None
+app.config['BLOB_GC_GRACE'] = 3600  # seconds an unreferenced pdf is kept
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # largest chunk of a resumable upload
+app.config['UPLOAD_SESSION_TTL'] = 24 * 3600  # seconds an unfinished upload is kept
+app.config['COMPRESS_MIN_SIZE'] = 1024  # smaller JSON bodies are sent as they are
+app.config['REPORT_ATTACH_MAX'] = 5 * 1024 * 1024  # larger exports are mailed as download links
+app.config['MAX_RATING'] = 5  # feedback ratings are whole numbers from 1
+app.config['IMPORT_CHUNK'] = 1000  # rows per insert transaction of a bulk import
+app.config['IMPORT_MAX_ERRORS'] = 1000  # rejected rows listed in an import report
 celery = Celery(
     app.name, broker=app.config['CELERY_BROKER_URL'], backend=app.config['RESULT_BACKEND'])
 celery.conf.update(app.config)
 celery.conf.enable_utc = False
 celery.conf.timezone = "Asia/Kolkata"
 cache = Cache(app)
+# the cache's Redis, for the structures Flask-Caching has no API for
+redis_client = redis.Redis(host=app.config['CACHE_REDIS_HOST'], port=app.config['CACHE_REDIS_PORT'],
+                           db=app.config['CACHE_REDIS_DB'], decode_responses=True)
 
 
 class ContextTask(Task):
@@ -1,70 +1,141 @@
-import smtplib
 from email.message import EmailMessage
 from email.mime.application import MIMEApplication
 import os
+import tempfile
 from dotenv import load_dotenv
-from Classes.Dbmodels import VisitHistory, Read, User, Book, Requests, Section, Librarian, Feedback
+from Classes.Dbmodels import VisitHistory, Read, User, Book, Requests, Section, Librarian, Feedback, db
 from datetime import datetime, timedelta
 from flask import render_template
 import pdfkit
-from init import app, celery
+from init import app, celery, cache, redis_client
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sqlalchemy import func
+from Classes.mailer import Mailer
+from Classes import blobs, export, reports, uploads, visits
 
 load_dotenv()
 
 SENDER = os.environ["EMAIL"] if "EMAIL" in os.environ else ""
 PASSWORD = os.environ["PASSWORD"] if "PASSWORD" in os.environ else ""
+REMINDER_KEY_TIMEOUT = 2 * 24 * 3600
 
 
-def send_daily_login_reminder(email, username):
+def new_mailer():
+    return Mailer(SENDER, PASSWORD)
+
+
+def deliver(msg, mailer=None):
+    # reuse the caller's connection when sending in bulk
+    if mailer is not None:
+        mailer.send(msg)
+        return
+    with new_mailer() as mailer:
+        mailer.send(msg)
+
+
+def send_daily_login_reminder(email, username, mailer=None):
     msg = EmailMessage()
     msg["Subject"] = "Login Reminder"
     msg["From"] = SENDER
     msg["To"] = email
     body = f"Hello {username},\nThis is your reminder to visit Libra !! \nSo many books waiting to be read\n\n\nThis is a auto generated text, Please Don't Reply"
     msg.set_content(body)
-    with smtplib.SMTP_SSL("smtp.gmail.com") as smtp:
-        smtp.login(SENDER, PASSWORD)
-        smtp.send_message(msg)
+    deliver(msg, mailer)
 
 
-def send_daily_return_reminder(email, username, books):
+def send_daily_return_reminder(email, username, books, mailer=None):
     msg = EmailMessage()
     msg["Subject"] = "Return Reminder"
     msg["From"] = SENDER
     msg["To"] = email
     body = f"Hello {username},\nThis is your reminder to return the following books !!\n\n"
-    body += "\n".join([book.name for book in books])
+    body += "\n".join(books)
     body += "\n\n\n This is a auto generated text, Please Don't Reply"
     msg.set_content(body)
-    with smtplib.SMTP_SSL("smtp.gmail.com") as smtp:
-        smtp.login(SENDER, PASSWORD)
-        smtp.send_message(msg)
+    deliver(msg, mailer)
 
 
-def generate_report(user):
+def report_period():
     year = datetime.now().year
     month = datetime.now().month
     start_date = datetime(year, month, 1)
     end_date = datetime(year, month+1, 1) + timedelta(days=-1)\
         if month != 12 else datetime(year, month, 31)
+    return start_date.date(), end_date.date()
+
 
-    number_of_days = len(VisitHistory.query.filter(VisitHistory.user_id ==
-                         user.email, VisitHistory.on >= start_date.date(), VisitHistory.on <= end_date.date()).all())
-    number_of_requests = len(
-        Requests.get_requests(user.email, start_date.date()))
+def monthly_user_numbers(start_date, end_date):
+    # every user's numbers for the month, from grouped queries instead of three per user
+    days = dict(db.session.query(VisitHistory.user_id, func.count(func.distinct(VisitHistory.on))).filter(
+        VisitHistory.on >= start_date, VisitHistory.on <= end_date).group_by(VisitHistory.user_id))
+    requests = dict(db.session.query(Requests.user_id, func.count(Requests.request_id)).filter(
+        Requests.opened_on >= start_date).group_by(Requests.user_id))
+    books = {}
+    for user_id, name, authors in db.session.query(Read.user_id, Book.name, Book.authors).join(
+            Book, Book.book_id == Read.book_id).filter(Read.on >= start_date, Read.on <= end_date):
+        books.setdefault(user_id, []).append(dict(name=name, authors=authors))
+    return days, requests, books
 
-    books_read = Read.query.filter(Read.user_id == user.email,
-                                   Read.on >= start_date, Read.on <= end_date).all()
-    books_read = [read.book.return_data() for read in books_read]
-    number_of_books_read = len(books_read)
 
-    pdf_template = render_template("report_template.html", date=end_date.date(), user=user,
-                                   number_of_days=number_of_days, books_read=number_of_books_read, books=books_read, number_of_requests=number_of_requests)
-    filename = user.nick_name+str(end_date.date())+".pdf"
+def render_pdf(html, path):
     pdf_config = pdfkit.configuration(wkhtmltopdf="/usr/bin/wkhtmltopdf")
-    pdfkit.from_string(pdf_template, os.path.join(
-        app.config["PRO_UPLOAD_FOLDER"], "reports", filename), configuration=pdf_config)
-    return filename
+    pdfkit.from_string(html, path, configuration=pdf_config)
+
+
+def render_stored(html):
+    # the same html always gives the same pdf, so each one is rendered once
+    # and served from the artifact store after that
+    key = reports.report_key("pdf", html, version=0)
+    files = reports.finished(key)
+    if files:
+        return files["pdf"]
+    handle, path = tempfile.mkstemp(suffix=".pdf", dir=os.path.join(
+        app.config["PRO_UPLOAD_FOLDER"], "reports"))
+    os.close(handle)
+    try:
+        render_pdf(html, path)
+    except Exception:
+        os.remove(path)
+        raise
+    stored = reports.store(path)
+    reports.remember(key, {"pdf": stored})
+    return stored
+
+
+def monthly_reports(batch=500):
+    # yields (email, path, filename) as reports finish rendering. wkhtmltopdf is
+    # a subprocess, so a thread pool renders in parallel (celery's prefork
+    # workers cannot start a process pool of their own); at most two renders
+    # per thread are queued, which keeps memory flat however many users there are
+    start_date, end_date = report_period()
+    days, requests, books = monthly_user_numbers(start_date, end_date)
+    workers = app.config["REPORT_WORKERS"]
+
+    def render(email, html, filename):
+        return email, render_stored(html), filename
+
+    def rendered(futures):
+        # a failed render costs that user the report, not everyone after them
+        for future in futures:
+            try:
+                yield future.result()
+            except Exception as e:
+                print(e)
+
+    users = db.session.query(User.email, User.nick_name).yield_per(batch)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for email, nick_name in users:
+            read = books.get(email, [])
+            html = render_template("report_template.html", date=end_date, user=dict(email=email, nick_name=nick_name),
+                                   number_of_days=days.get(email, 0), books_read=len(read), books=read, number_of_requests=requests.get(email, 0))
+            pending.add(pool.submit(render, email, html,
+                        nick_name+str(end_date)+".pdf"))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from rendered(done)
+        yield from rendered(wait(pending).done)
 
 
 def generate_report_librarian():
@@ -80,34 +151,27 @@ def generate_report_librarian():
         start_date.date(), end_date.date())
     pdf_template = render_template(
         "librarian_report_template.html", requests=requests, feedbacks=feedbacks, date=end_date.date(), book_count=books_count, section_count=sections_count)
-    pdf_config = pdfkit.configuration(wkhtmltopdf="/usr/bin/wkhtmltopdf")
     file = f"librarian{str(end_date.date())}.pdf"
-    pdfkit.from_string(pdf_template, os.path.join(
-        app.config["PRO_UPLOAD_FOLDER"], "reports", file), configuration=pdf_config)
-    return file
+    return render_stored(pdf_template), file
 
 
-def send_monthly_report(user):
-    file = generate_report(user)
+def send_report_mail(email, attach_file_name, file, mailer=None):
     msg = EmailMessage()
     msg["Subject"] = "Your Monthly Report "
     msg["From"] = SENDER
-    msg["To"] = user.email
+    msg["To"] = email
     body = "Attached below is your monthly report for last month"
     msg.set_content(body)
-    attach_file_name = os.path.join(
-        app.config["PRO_UPLOAD_FOLDER"], 'reports', file)
-    attach_file = MIMEApplication(open(attach_file_name, "rb").read())
+    with open(attach_file_name, "rb") as report:
+        attach_file = MIMEApplication(report.read())
     attach_file.add_header('Content-Disposition',
                            'attachment', filename=file)
     msg.add_attachment(attach_file)
-    with smtplib.SMTP_SSL("smtp.gmail.com") as smtp:
-        smtp.login(SENDER, PASSWORD)
-        smtp.send_message(msg)
+    deliver(msg, mailer)
 
 
-def send_monthly_report_librarian(mail):
-    file = generate_report_librarian()
+def send_monthly_report_librarian(mail, mailer=None):
+    attach_file_name, file = generate_report_librarian()
 
     msg = EmailMessage()
     msg["Subject"] = "Monthly Report"
@@ -115,33 +179,72 @@ def send_monthly_report_librarian(mail):
     msg["To"] = mail
     body = "Attached below is the monthly report"
     msg.set_content(body)
-    attach_file_name = os.path.join(
-        app.config["PRO_UPLOAD_FOLDER"], "reports", file)
     attach_file = MIMEApplication(open(attach_file_name, "rb").read())
     attach_file.add_header('Content-Disposition',
                            'attachment', filename=file)
     msg.add_attachment(attach_file)
-    with smtplib.SMTP_SSL("smtp.gmail.com") as smtp:
-        smtp.login(SENDER, PASSWORD)
-        smtp.send_message(msg)
+    deliver(msg, mailer)
+    return attach_file_name
 
 
-def send_librarian_report(mail):
+def send_librarian_report(mail, files, task_id, mailer=None):
+    # small exports are attached, larger ones only announced with their
+    # download links, so neither the worker nor the mail carries them
     msg = EmailMessage()
     msg["Subject"] = "Async CSV Generation output"
     msg["From"] = SENDER
     msg["To"] = mail
-    body = "Attached below is the generated csv file"
+    if sum(os.path.getsize(path) for path in files.values()) > app.config["REPORT_ATTACH_MAX"]:
+        body = "The csv export is ready, download it from:\n\n"
+        body += "\n".join(f"/librarian/generate_report/download?task_id={task_id}&entity={entity}"
+                          for entity in files)
+        msg.set_content(body)
+        deliver(msg, mailer)
+        return
+    body = "Attached below is the generated csv export"
     msg.set_content(body)
-    attach_file_name = os.path.join(
-        app.config["PRO_UPLOAD_FOLDER"], 'report.csv')
-    attach_file = MIMEApplication(open(attach_file_name, "rb").read())
-    attach_file.add_header('Content-Disposition',
-                           'attachment', filename="output.csv")
-    msg.add_attachment(attach_file)
-    with smtplib.SMTP_SSL("smtp.gmail.com") as smtp:
-        smtp.login(SENDER, PASSWORD)
-        smtp.send_message(msg)
+    for entity, attach_file_name in files.items():
+        with open(attach_file_name, "rb") as report:
+            attach_file = MIMEApplication(report.read())
+        attach_file.add_header('Content-Disposition',
+                               'attachment', filename=reports.download_name(entity, attach_file_name))
+        msg.add_attachment(attach_file)
+    deliver(msg, mailer)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def summary_key(run_id):
+    return f"reminders:summary:{run_id}"
+
+
+def reminder_summary(run_id=None):
+    # the counters the batches add to as they finish
+    run_id = run_id or redis_client.get("reminders:latest")
+    key = summary_key(run_id) if run_id else None
+    counters = redis_client.hgetall(key) if key else None
+    if not counters:
+        return None
+    summary = {name: int(counters.get(name, 0))
+               for name in ("batches", "finished", "sent", "failed", "skipped")}
+    done = counters.get("dispatched") and summary["finished"] >= summary["batches"]
+    summary["status"] = "done" if done else "running"
+    summary["failures"] = redis_client.lrange(f"{key}:failures", 0, -1)
+    return dict(summary, run=run_id)
+
+
+def claim_reminder(key, owner):
+    # "sent" is final. A pending claim under our own task id is left over from
+    # a delivery whose worker died mid-send (acks_late redelivers it with the
+    # same id), so that message goes out again
+    claim = f"pending:{owner}"
+    if cache.add(key, claim, timeout=REMINDER_KEY_TIMEOUT):
+        return True
+    return cache.get(key) == claim
 
 
 """
@@ -151,14 +254,102 @@ def send_librarian_report(mail):
 
 @celery.task(name="send_daily_reminder_task")
 def send_daily_reminder_task():
-    users = VisitHistory.unvisited()
-    emails = [(user.email, user.nick_name) for user in users]
-    for email, nick_name in emails:
-        send_daily_login_reminder(email, nick_name)
-    users = Book.due_users()
-    for user in users:
-        if user:
-            send_daily_return_reminder(user.email, user.nick_name, users[user])
+    # each batch is sent off as soon as it is enumerated, so neither this task
+    # nor a single broker message ever holds the whole recipient list
+    visits.flush()
+    run_id = str(datetime.today().date())
+    size = app.config["REMINDER_BATCH_SIZE"]
+    key = summary_key(run_id)
+    redis_client.delete(key, f"{key}:failures", f"{key}:batches")
+    redis_client.set("reminders:latest", run_id)
+    recipients = [("login", VisitHistory.unvisited()),
+                  ("return", Book.due_users(app.config["RETURN_REMINDER_DAYS"]))]
+    number = 0
+    for kind, rows in recipients:
+        for batch in batched(rows, size):
+            number += 1
+            redis_client.hincrby(key, "batches")
+            send_reminder_batch.delay(run_id, kind, batch, number)
+    redis_client.hset(key, "dispatched", 1)
+    redis_client.expire(key, REMINDER_KEY_TIMEOUT)
+    return number
+
+
+@celery.task(name="send_reminder_batch", bind=True, acks_late=True, rate_limit=app.config["REMINDER_RATE_LIMIT"])
+def send_reminder_batch(self, run_id, kind, recipients, number):
+    # every message is claimed under an idempotency key, so a redelivered
+    # batch skips what already went out
+    result = dict(sent=0, failed=0, skipped=0, failures=[])
+    with new_mailer() as mailer:
+        for recipient in recipients:
+            key = f"reminders:{run_id}:{kind}:{recipient[0]}"
+            if not claim_reminder(key, self.request.id):
+                result["skipped"] += 1
+                continue
+            try:
+                if kind == "login":
+                    send_daily_login_reminder(*recipient, mailer)
+                else:
+                    send_daily_return_reminder(*recipient, mailer)
+            except Exception as e:
+                print(e)
+                cache.delete(key)
+                result["failed"] += 1
+                result["failures"].append(recipient[0])
+                continue
+            cache.set(key, "sent", timeout=REMINDER_KEY_TIMEOUT)
+            result["sent"] += 1
+    key = summary_key(run_id)
+    # a batch redelivered after it was counted is not counted again
+    if redis_client.sadd(f"{key}:batches", number):
+        pipe = redis_client.pipeline()
+        pipe.hincrby(key, "finished")
+        for name in ("sent", "failed", "skipped"):
+            pipe.hincrby(key, name, result[name])
+        if result["failures"]:
+            pipe.rpush(f"{key}:failures", *result["failures"])
+            pipe.ltrim(f"{key}:failures", 0, 99)
+        for name in (key, f"{key}:failures", f"{key}:batches"):
+            pipe.expire(name, REMINDER_KEY_TIMEOUT)
+        pipe.execute()
+    return result
+
+
+def pending_render(book_id, token):
+    # the book, as long as it still waits for the render queued with token
+    query = Book.query.filter(Book.book_id == book_id, Book.pdf_status == "pending")
+    return query if token is None else query.filter(Book.pdf_render == token)
+
+
+@celery.task(name="render_book_pdf")
+def render_book_pdf(book_id, token=None):
+    # an upload or a newer render request since this one was queued makes it
+    # stale, so only the latest request ever lands
+    book = pending_render(book_id, token).first()
+    if book is None:
+        return "stale"
+    pdf_template = render_template(
+        "book_template.html", title=book.name, authors=book.authors, content=book.content)
+    path = blobs.scratch()
+    try:
+        render_pdf(pdf_template, path)
+        status = "ready"
+    except Exception as e:
+        print(e)
+        status = "failed"
+    # checked again with a write, which holds the lock until the commit
+    if not pending_render(book_id, token).update({Book.pdf_status: status}, synchronize_session=False):
+        db.session.rollback()
+        status = "stale"
+    elif status == "ready":
+        blobs.swap(book, blobs.store_file(path))
+        book.pdf_status = status
+        db.session.commit()
+    else:
+        db.session.commit()
+    if os.path.exists(path):
+        os.remove(path)
+    return status
 
 
 @celery.task(name="send_monthly_report_task")
@@ -166,61 +357,62 @@ def send_monthly_report_task():
     today = datetime.today()
     tomorrow = today + timedelta(days=1)
     if tomorrow.day == 1:  # today is last date
-        users = User.query.all()
-        for user in users:
-            send_monthly_report(user)
-        send_monthly_report_librarian(Librarian.query.first().mail)
-
-
-@celery.task
-def generate_librarian_report(mail):
-    books = Book.query.all()
-    books = [book.return_data() for book in books]
-    book_headers = ["id", "name", "authors", "section_id",
-                    "email", "content", "issue_date", "return_date"]
-    with open(f"{app.config['PRO_UPLOAD_FOLDER']}/report.csv", "w") as csvfile:
-        csvfile.write(
-            "Books\nID,Book Name,Authors,Section Id, User_email,content,issue_date,return_date\n")
-        for book in books:
-            for key in book_headers:
-                csvfile.write(str(book[key])+",")
-            csvfile.write("\n")
-
-    sections = Section.query.all()
-    sections = [section.return_data() for section in sections]
-    section_headers = ["id", "name", "description", "books"]
-    with open(f"{app.config['PRO_UPLOAD_FOLDER']}/report.csv", "a") as csvfile:
-        csvfile.write(
-            "Sections\nID,Name,Description, Number of Books\n")
-        for section in sections:
-            for key in section_headers:
-                if key == "books":
-                    csvfile.write((str(len(section[key])))+",")
-                else:
-                    csvfile.write(str(section[key])+",")
-            csvfile.write("\n")
-
-    requests = Requests.query.all()
-    requests = [request.return_data() for request in requests]
-    request_headers = ["id", "user_id", "book_id",
-                       "pending", "opened_on", "closed_on", "outcome"]
-    with open(f"{app.config['PRO_UPLOAD_FOLDER']}/report.csv", "a") as csvfile:
-        csvfile.write(
-            "Requests\nID,User_email,Book Id, Pending Status,Opened On,Closed On,Outcome\n")
-        for request in requests:
-            for key in request_headers:
-                csvfile.write(str(request[key])+",")
-            csvfile.write("\n")
-
-    feedbacks = Feedback.query.all()
-    feedbacks = [feedback.return_data() for feedback in feedbacks]
-    request_headers = ["id", "book_name",
-                       "rating", "feedback", "user_name", "on"]
-    with open(f"{app.config['PRO_UPLOAD_FOLDER']}/report.csv", "a") as csvfile:
-        csvfile.write(
-            "Feedbacks\nID,Book Name,Rating, Feedback,User_email,On\n")
-        for request in feedbacks:
-            for key in request_headers:
-                csvfile.write(str(request[key])+",")
-            csvfile.write("\n")
-    send_librarian_report(mail)
+        # one run per month, however many times beat fires
+        key = reports.report_key("monthly", report_period(), version=0)
+        if reports.finished(key) or not reports.claim(key):
+            return
+        try:
+            visits.flush()
+            with new_mailer() as mailer:
+                for email, path, file in monthly_reports():
+                    try:
+                        send_report_mail(email, path, file, mailer)
+                    except Exception as e:
+                        print(e)
+                path = send_monthly_report_librarian(
+                    Librarian.query.first().mail, mailer)
+            reports.remember(key, {"librarian": path})
+        finally:
+            reports.release(key)
+
+
+@celery.task(name="collect_blobs_task")
+def collect_blobs_task():
+    uploads.expire()
+    return blobs.collect()
+
+
+@celery.task(name="flush_visits_task")
+def flush_visits_task():
+    return visits.flush()
+
+
+@celery.task(bind=True)
+def generate_librarian_report(self, mail, fmt="zip", mode="full", key=None):
+    # full: one csv per entity, streamed into a zip or gzipped files
+    # delta: only what changed since the last delta run, compact: fold the
+    # deltas into a fresh snapshot
+    # full exports are kept in the artifact store, the incremental chain stays
+    # where the next delta run expects it
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    directory = os.path.join(app.config["PRO_UPLOAD_FOLDER"], "exports")
+    try:
+        if mode == "delta":
+            files = export.export_incremental(
+                os.path.join(directory, "incremental"))
+        elif mode == "compact":
+            files = export.compact(os.path.join(directory, "incremental"))
+            files = {entity: path for entity, path in files.items() if path}
+        else:
+            files = export.export(
+                directory, f"report-{stamp}-{self.request.id}", fmt)
+            files = {entity: reports.store(path)
+                     for entity, path in files.items()}
+            if key is not None:
+                reports.remember_run(key, self.request.id)
+        reports.remember(self.request.id, files)
+    finally:
+        reports.release(key or self.request.id)
+    if mail:
+        send_librarian_report(mail, files, self.request.id)
+    return {"files": files}
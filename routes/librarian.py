@@ -1,57 +1,23 @@
-from flask import request, jsonify, render_template
-from init import app, cache, online_users, celery
-from jobs import generate_librarian_report
-from werkzeug.utils import secure_filename
-from Classes.Dbmodels import Book, Section, Requests, Librarian, db
-import random
+from flask import request, jsonify, send_from_directory
+from init import app, celery
+from jobs import generate_librarian_report, reminder_summary, render_book_pdf
+from Classes.Dbmodels import Book, Section, Requests, Librarian, User, db
+from Classes import auth, blobs, catalog, importer, invalidation, presence, reports, search, stats, uploads
+from Classes.pagination import paginated, keyset, page as make_page
+from Classes.responses import versioned
 import datetime
+import io
 import jwt
 import os
+import uuid
 from functools import wraps
-import pdfkit
 from celery.result import AsyncResult
 
 """
 Librarian endpoints
 """
 
-
-def token_required(fun):
-    @wraps(fun)
-    def _verify(*args, **kwargs):
-        auth_headers = request.headers.get('Authorization', '').split()
-        invalid_msg = {
-            'message': 'Invalid token',
-            'authenticated': False,
-            'invalid': True
-        }
-        expired_msg = {
-            'message': 'Expired token',
-            'authenticated': False,
-            'invalid': True
-        }
-
-        if len(auth_headers) != 2:
-            return jsonify(invalid_msg), 401
-
-        try:
-            token = auth_headers[1]
-            data = jwt.decode(
-                token, app.config['SECRET_KEY'], algorithms="HS256")
-            if data['role'] != "librarian":
-                return jsonify(invalid_msg), 401
-            librarian = Librarian.query.filter_by(
-                user_name=data['email']).first()
-            if not librarian:
-                raise RuntimeError('Librarian not found')
-            return fun(librarian, *args, **kwargs)
-        except jwt.ExpiredSignatureError:
-            return jsonify(expired_msg), 401
-        except (jwt.InvalidTokenError, Exception) as e:
-            print(e)
-            return jsonify(invalid_msg), 401
-
-    return _verify
+token_required = auth.token_required("librarian")
 
 
 def validate(check):
@@ -89,27 +55,50 @@ def librarian_login():
 
 @app.route("/librarian/getactiveusers", methods=["GET"])
 @token_required
-def get_active_users(librarian):
-    global online_users
-    return jsonify([user.return_data() for user in online_users])
+@paginated
+def get_active_users(librarian, page):
+    emails, next_cursor = presence.active(
+        *(page or (None, None)))
+    users = {user.email: user for user in User.query.filter(
+        User.email.in_(emails))} if emails else {}
+    response = [users[email].return_data()
+                for email in emails if email in users]
+    if page is None:
+        return jsonify(response)
+    return jsonify(make_page(response, next_cursor))
 
 
 @app.route("/librarian/sections", methods=["GET"])
 @token_required
-@cache.memoize(timeout=3600)
-def librarian_sections(librarian):
-    sections = Section.query.all()
-    sections = [section.return_data() for section in sections]
-    return sections
+@versioned("books")
+@paginated
+def librarian_sections(librarian, page):
+    if page is None:
+        sections = catalog.librarian_sections()
+        return sections
+    return catalog.librarian_sections_page(*page)
+
+
+@app.route("/librarian/sections/<int:section_id>/books", methods=["GET"])
+@token_required
+@versioned("books")
+@paginated
+def librarian_section_books(librarian, section_id, page):
+    # continues a section from the books_cursor of /librarian/sections
+    if page is None:
+        return {"error": "only available paginated"}, 400
+    return catalog.librarian_books_page(*page, section_id=section_id)
 
 
 @app.route("/librarian/books", methods=["GET"])
 @token_required
-@cache.memoize(timeout=3600)
-def librarian_books(librarian):
-    books = Book.query.all()
-    books = [book.return_data() for book in books]
-    return books
+@versioned("books")
+@paginated
+def librarian_books(librarian, page):
+    if page is None:
+        books = catalog.librarian_books()
+        return books
+    return catalog.librarian_books_page(*page)
 
 
 @app.route("/librarian/book/<int:book_id>")
@@ -121,6 +110,24 @@ def retrive_book(librarian, book_id):
     return book.return_data(), 200
 
 
+@app.route("/librarian/book/<int:book_id>/pdf_status", methods=["GET", "POST"])
+@token_required
+def book_pdf_status(librarian, book_id):
+    # POST queues the render again after it failed
+    book = Book.query.filter_by(book_id=book_id).first()
+    if book is None:
+        return {"error": "book does not exist"}, 400
+    if request.method == "POST":
+        if book.pdf_status != "failed":
+            return {"error": "only a failed render can be retried", "pdf_status": book.pdf_status}, 409
+        token = book.queue_render()
+        db.session.commit()
+        render_book_pdf.delay(book.book_id, token)
+        invalidation.book_changed(book_id)
+        return {"id": book.book_id, "pdf_status": book.pdf_status}, 202
+    return {"id": book.book_id, "pdf_status": book.pdf_status}, 200
+
+
 @app.route("/librarian/section/<int:section_id>")
 @token_required
 def retrive_section(librarian, section_id):
@@ -133,12 +140,8 @@ def retrive_section(librarian, section_id):
 @app.route("/librarian/graph/books", methods=["GET"])
 @token_required
 def librarian_graph_books(librarian):
-    books = Book.query.all()
-    if not books:
-        return jsonify({"chart_data": [0, 0]}), 200
-    notinuse = len(Book.query.filter_by(user_email=None).all())
-
-    values = [len(books)-notinuse, notinuse]
+    response = stats.dashboard()
+    values = [response["books_in_use"], response["books_available"]]
     return jsonify({"chart_data": values}), 200
 
 
@@ -149,16 +152,20 @@ def librarian_remove_book(librarian, book_id):
     if book is None:
         return {"error": "book does not exist"}, 404
     else:
+        users = [book.user_email] + [i.user_email for i in book.owners]
         for i in book.feedbacks:
             db.session.delete(i)
         for i in book.owners:
             db.session.delete(i)
         for i in book.readby:
             db.session.delete(i)
-        os.remove(app.config["UPLOAD_FOLDER"]+"/"+book.file_name)
+        # the file goes once no book uses it, see blobs.collect
+        blobs.release(book.file_name)
         db.session.delete(book)
         db.session.commit()
-        cache.clear()
+        invalidation.book_changed(book_id)
+        invalidation.user_changed(*users)
+        invalidation.catalog_changed()
         return {"message": "done"}, 200
 
 
@@ -169,13 +176,16 @@ def librarian_remove_section(librarian, section_id):
     if section is None:
         return {"error", "section does not exist"}, 404
 
+    book_ids = []
     for book in section.books:
         book.section_id = 0
+        book_ids.append(book.book_id)
         db.session.add(book)
         db.session.commit()
     db.session.delete(section)
     db.session.commit()
-    cache.clear()
+    invalidation.book_changed(*book_ids)
+    invalidation.catalog_changed()
     return {"message": "done"}, 200
 
 
@@ -187,10 +197,12 @@ def librarian_revoke_book(librarian, book_id):
         return {"error": "book does not exist"}, 404
     if book.user_email is None:
         return {"error": "no one has the book"}, 404
+    holder = book.user_email
     book.user_email = None
     db.session.add(book)
     db.session.commit()
-    cache.clear()
+    invalidation.book_changed(book_id)
+    invalidation.user_changed(holder)
     return {"message": "done"}, 200
 
 
@@ -200,14 +212,13 @@ def librarian_revoke_book(librarian, book_id):
 def librarian_search_books(librarian):
 
     data = request.get_json()
-    search_key = '%'+data.get('key')+'%'
     index = data.get('index')
-    if index == '1':
-        books = Book.query.filter(Book.name.like(search_key)).all()
-    elif index == '3':
+    if index == '3':
+        search_key = '%'+data.get('key')+'%'
         books = Book.query.filter(Book.user_email.like(search_key)).all()
     else:
-        books = Book.query.filter(Book.authors.like(search_key)).all()
+        books = search.search_books(data.get('key'), search.book_columns(
+            index), limit=data.get('limit'))
     books = [book.return_data() for book in books]
     return jsonify(books), 200
 
@@ -217,8 +228,7 @@ def librarian_search_books(librarian):
 @validate(["key"])
 def librarian_search_sections(librarian):
     data = request.get_json()
-    search_key = '%'+data.get('key')+'%'
-    sections = Section.query.filter(Section.name.like(search_key)).all()
+    sections = search.search_sections(data.get('key'), limit=data.get('limit'))
     sections = [section.return_data() for section in sections]
     return jsonify(sections), 200
 
@@ -229,44 +239,32 @@ def librarian_add_book(librarian):
     file = request.files.get('content')
     if file:
         if '.' in file.filename and file.filename.split(".")[-1] == "pdf":
-            filename = secure_filename(
-                file.filename) + request.form["authors"] + str(datetime.date.today())
-            filename = list(filename)
-            random.shuffle(filename)
-            filename = ''.join(filename)+".pdf"
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+            filename = blobs.ingest(file.stream)
             book = Book(
                 name=request.form["name"], authors=request.form["authors"],
                 section_id=request.form["section_id"],
-                file_name=filename, content=request.form["content1"]
+                content=request.form["content1"], pdf_status="ready"
             )
+            blobs.swap(book, filename)
             db.session.add(book)
             db.session.commit()
-            cache.clear()
+            invalidation.catalog_changed()
             return {"message": "done"}, 200
         else:
             return {"error": "Need .pdf"}, 400
 
-    filename = request.form["name"] + \
-        request.form["authors"] + str(datetime.date.today())
-    filename = list(filename)
-    random.shuffle(filename)
-    filename = ''.join(filename)+".pdf"
-    pdf_template = render_template(
-        "book_template.html", title=request.form["name"], authors=request.form["authors"], content=request.form["content1"])
-    pdf_config = pdfkit.configuration(wkhtmltopdf="/usr/bin/wkhtmltopdf")
-    pdfkit.from_string(pdf_template, os.path.join(
-        app.config["UPLOAD_FOLDER"], filename), configuration=pdf_config)
-
+    # the pdf is rendered by a worker, the book is usable right away
     book = Book(
         name=request.form["name"], authors=request.form["authors"],
-        section_id=request.form["section_id"] if request.form["section_id"] else 0, file_name=filename,
+        section_id=request.form["section_id"] if request.form["section_id"] else 0,
         content=request.form["content1"]
     )
+    token = book.queue_render()
     db.session.add(book)
     db.session.commit()
-    cache.clear()
-    return {"message": "done"}, 200
+    render_book_pdf.delay(book.book_id, token)
+    invalidation.catalog_changed()
+    return {"message": "done", "id": book.book_id, "pdf_status": book.pdf_status}, 200
 
 
 @app.route("/librarian/modify/book/<int:book_id>", methods=["POST"])
@@ -287,42 +285,118 @@ def librarian_modify_book(librarian, book_id):
     file = request.files.get('content')
     if file:
         if '.' in file.filename and file.filename.split(".")[-1] == "pdf":
-            filename = book.file_name
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+            blobs.swap(book, blobs.ingest(file.stream))
 
             book.name = request.form["name"]
             book.content = request.form["content1"]
             book.authors = request.form["authors"]
             book.section_id = request.form["section_id"]
+            book.pdf_status = "ready"
 
             db.session.add(book)
             db.session.commit()
-            cache.clear()
+            invalidation.book_changed(book_id)
+            invalidation.catalog_changed()
             return {"message": "done"}, 200
         else:
             return {"error": "Need .pdf"}, 400
 
-    filename = book.file_name
-
     if content == "":
         return {"error": "both pdf and content not provided"}, 404
     book.name = name
     book.content = content
     book.authors = authors
     book.section_id = section_id
-    if overwrite:
-        pdf_template = render_template(
-            "book_template.html", title=request.form["name"], authors=request.form["authors"], content=request.form["content1"])
-        pdf_config = pdfkit.configuration(wkhtmltopdf="/usr/bin/wkhtmltopdf")
-        pdfkit.from_string(pdf_template, os.path.join(
-            app.config["UPLOAD_FOLDER"], filename), configuration=pdf_config)
+    token = book.queue_render() if overwrite else None
 
     db.session.add(book)
     db.session.commit()
-    cache.clear()
+    if overwrite:
+        render_book_pdf.delay(book.book_id, token)
+    invalidation.book_changed(book_id)
+    invalidation.catalog_changed()
     return {"message": "done"}, 200
 
 
+@app.route("/librarian/import/books", methods=["POST"])
+@token_required
+def import_books(librarian):
+    # CSV or JSON Lines, as a multipart "file" or as the raw body
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "jsonl"):
+        return {"error": "format must be csv or jsonl"}, 400
+    upload = request.files.get("file")
+    stream = upload.stream if upload is not None else request.stream
+    with io.TextIOWrapper(stream, encoding="utf-8-sig", errors="surrogateescape", newline="") as textfile:
+        report = importer.import_books(textfile, fmt)
+    return jsonify(report), 200
+
+
+@app.route("/librarian/uploads", methods=["POST"])
+@token_required
+@validate(["size", "sha256"])
+def upload_start(librarian):
+    data = request.get_json()
+    try:
+        return jsonify(uploads.start(data["size"], data["sha256"])), 201
+    except uploads.UploadError as e:
+        return {"error": str(e)}, e.status
+
+
+@app.route("/librarian/uploads/<string:upload_id>", methods=["GET", "PUT", "DELETE"])
+@token_required
+def upload_chunk(librarian, upload_id):
+    session = uploads.get(upload_id)
+    if session is None:
+        return {"error": "upload does not exist"}, 404
+    if request.method == "DELETE":
+        uploads.abort(upload_id)
+        return {"message": "done"}, 200
+    if request.method == "GET":
+        return jsonify(uploads.status(session)), 200
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return {"error": "offset is required"}, 400
+    try:
+        return jsonify(uploads.write(session, offset, request.stream, request.content_length)), 200
+    except uploads.UploadError as e:
+        return {"error": str(e), **uploads.status(session)}, e.status
+
+
+@app.route("/librarian/uploads/<string:upload_id>/finalize", methods=["POST"])
+@token_required
+def upload_finalize(librarian, upload_id):
+    # attaches the file to book_id, or creates a book from name, authors,
+    # section_id and content1
+    session = uploads.get(upload_id)
+    if session is None:
+        return {"error": "upload does not exist"}, 404
+    data = request.get_json()
+    book_id = data.get("book_id")
+    if book_id is not None:
+        book = Book.query.filter_by(book_id=book_id).first()
+        if book is None:
+            return {"error": "book does not exist"}, 404
+    else:
+        if not data.get("name") or not data.get("authors"):
+            return {"error": "some fields are empty"}, 400
+        book = Book(name=data["name"], authors=data["authors"], section_id=data.get("section_id") or 0,
+                    content=data.get("content1", ""))
+    try:
+        filename = uploads.finish(session)
+    except uploads.UploadError as e:
+        return {"error": str(e)}, e.status
+    blobs.swap(book, filename)
+    book.pdf_status = "ready"
+    db.session.add(book)
+    db.session.commit()
+    if book_id is not None:
+        invalidation.book_changed(book.book_id)
+    invalidation.catalog_changed()
+    return {"message": "done", "id": book.book_id, "file_name": book.file_name}, 200
+
+
 @app.route("/librarian/modify/section/<int:section_id>", methods=["POST"])
 @token_required
 @validate(["name", "description"])
@@ -339,7 +413,7 @@ def librarian_modify_section(librarian, section_id):
     section.name = name
     db.session.add(section)
     db.session.commit()
-    cache.clear()
+    invalidation.catalog_changed()
     return {"message": "done"}, 200
 
 
@@ -359,7 +433,7 @@ def librarian_add_section(librarian):
     )
     db.session.add(section)
     db.session.commit()
-    cache.clear()
+    invalidation.catalog_changed()
     return {"message": "done"}
 
 
@@ -371,6 +445,7 @@ def process_request(librarian, choice, request_id):
         if _request is None:
             return {"error": "request does not exist"}, 404
         book = Book.query.filter_by(book_id=_request.book_id).first()
+        holder = book.user_email
 
         book.user_email = _request.user_id
         book.issue_date = datetime.date.today()
@@ -381,7 +456,9 @@ def process_request(librarian, choice, request_id):
         db.session.add(book)
         db.session.add(_request)
         db.session.commit()
-        cache.clear()  # invalidate everything
+        # only the book's availability and the users involved change
+        invalidation.book_changed(book.book_id)
+        invalidation.user_changed(_request.user_id, holder)
         return {"message": "done"}, 200
     elif choice == 1:
         _request = Requests.query.filter_by(request_id=request_id).first()
@@ -392,24 +469,43 @@ def process_request(librarian, choice, request_id):
         _request.outcome = "rejected"
         db.session.add(_request)
         db.session.commit()
-        cache.clear()
+        invalidation.requests_changed()
         return {"message": "done"}, 200
     return {"error": "invalid choice"}
 
 
 @app.route("/librarian/requests", methods=["GET"])
 @token_required
-def book_requests(librarian):
-    requests = Requests.query.filter_by(pending=True).all()
-    requests = [request.return_data() for request in requests]
-    return requests, 200
+@paginated
+def book_requests(librarian, page):
+    requests = Requests.with_holder(Requests.query.filter_by(pending=True))
+    if page is None:
+        return Requests.serialize(requests), 200
+    requests, next_cursor = keyset(
+        requests, [Requests.request_id], *page, entity=lambda row: row[0])
+    return make_page(Requests.serialize(requests), next_cursor), 200
 
 
 @app.route("/librarian/generate_report", methods=["GET"])
 @token_required
 def generate_report(librarian):
-    task = generate_librarian_report.apply_async(args=[librarian.mail])
-    return {"message": "started", "task_id": task.id}, 200
+    fmt = "gzip" if request.args.get("format") == "gzip" else "zip"
+    mode = request.args.get("mode", "full")
+    if mode not in ("full", "delta", "compact"):
+        return {"message": "mode must be full, delta or compact"}, 400
+    # repeated clicks share one run; a full export of unchanged data is not
+    # run again, delta and compact are (each run starts from the last one)
+    key = reports.report_key("librarian_export", [fmt, mode])
+    if mode == "full":
+        run_id = reports.last_run(key)
+        if run_id and reports.finished(run_id):
+            return {"message": "ready", "task_id": run_id}, 200
+    run_id = str(uuid.uuid4())
+    if not reports.claim(key, run_id):
+        return {"message": "running", "task_id": reports.running(key)}, 200
+    generate_librarian_report.apply_async(
+        args=[librarian.mail, fmt, mode, key], task_id=run_id)
+    return {"message": "started", "task_id": run_id}, 200
 
 
 @app.route("/librarian/generate_report/status", methods=["GET"])
@@ -418,6 +514,8 @@ def report_status(librarian):
     task_id = request.args.get('task_id')
     if task_id is None:
         return jsonify({'status': 'ERROR', 'message': 'Task ID is required'})
+    if reports.finished(task_id):
+        return jsonify({'status': 'success'})
     task_result = AsyncResult(task_id, app=celery)
     if task_result.successful():
         return jsonify({'status': 'success'})
@@ -426,15 +524,51 @@ def report_status(librarian):
     return jsonify({'status': 'pending'})
 
 
+@app.route("/librarian/generate_report/download", methods=["GET"])
+@token_required
+def report_download(librarian):
+    task_id = request.args.get('task_id')
+    if task_id is None:
+        return jsonify({'status': 'ERROR', 'message': 'Task ID is required'}), 400
+    files = reports.recorded(task_id)
+    if files is None:
+        task_result = AsyncResult(task_id, app=celery)
+        if not task_result.successful():
+            return jsonify({'status': 'pending'}), 404
+        files = task_result.result["files"]
+    entity = request.args.get("entity", "zip")
+    path = files.get(entity)
+    if path is None:
+        return jsonify({'status': 'ERROR', 'message': 'available: ' + ", ".join(files)}), 404
+    if not os.path.exists(path):
+        # folded into a later snapshot by a compact run
+        return jsonify({'status': 'ERROR', 'message': 'file no longer exists'}), 410
+    return send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path), as_attachment=True,
+                               download_name=reports.download_name(entity, path))
+
+
 @app.route("/librarian/getstats")
 @token_required
-def stats(librarian):
-    response = {}
-    response["requests"] = len(Requests.query.all())
-    response["arequests"] = len(
-        Requests.query.filter_by(outcome="accepted").all())
-    response["rrequests"] = len(
-        Requests.query.filter_by(outcome="rejected").all())
-    response["books"] = len(Book.query.all())
-    response["sections"] = len(Section.query.all())
+def librarian_stats(librarian):
+    response = stats.dashboard()
+    response = {key: response[key] for key in (
+        "requests", "arequests", "rrequests", "books", "sections")}
     return jsonify(response), 200
+
+
+@app.route("/librarian/dashboard")
+@token_required
+def librarian_dashboard(librarian):
+    response = stats.dashboard()
+    response["chart_data"] = [response["books_in_use"],
+                              response["books_available"]]
+    return jsonify(response), 200
+
+
+@app.route("/librarian/reminders/status")
+@token_required
+def reminders_status(librarian):
+    summary = reminder_summary(request.args.get("run"))
+    if summary is None:
+        return {"error": "no reminder run found"}, 404
+    return jsonify(summary), 200
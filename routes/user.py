@@ -1,6 +1,9 @@
-from init import app, cache, online_users
+from init import app
 from flask import url_for, request, send_from_directory, jsonify
-from Classes.Dbmodels import Book, User, Section, Feedback, Requests, Owner, db, Read, VisitHistory
+from Classes.Dbmodels import Book, User, Feedback, Requests, Owner, db, Read
+from Classes import auth, catalog, invalidation, presence, search, visits
+from Classes.pagination import paginated, keyset, page as make_page
+from Classes.responses import versioned
 import datetime
 import jwt
 from functools import wraps
@@ -9,65 +12,23 @@ from functools import wraps
 User endpoints
 """
 
+token_required = auth.token_required("user")
+
 
 def calculate_rating(user, books):
-    ordered_books = []
+    # books arrive already ordered by rating, the aggregate lives on the row
+    books = [catalog.book_data(book) for book in books]
+    return catalog.apply_overlay(books, catalog.user_overlay(user))
+
+
+def sections_with_books(user, sections, books):
+    overlay = catalog.user_overlay(user)
+    books_dict = {section.section_id: [] for section in sections}
     for book in books:
-        score = 0
-        for feedback in book.feedbacks:
-            score += feedback.rating
-            if len(book.feedbacks) != 0:
-                score /= len(book.feedbacks)
-        ordered_books.append((round(score, 2), book))
-    ordered_books.sort(key=lambda x: x[0])
-    ordered_books.reverse()
-    response = []
-    for rating, book in ordered_books:
-        temp = book.return_data()
-        temp["owner"] = False
-        for i in user.owns:
-            if int(i.book_id) == book.book_id:
-                temp["owner"] = True
-        temp["rating"] = rating
-        response.append(temp)
-    return response
-
-
-def token_required(fun):
-    @wraps(fun)
-    def _verify(*args, **kwargs):
-        auth_headers = request.headers.get('Authorization', '').split()
-        invalid_msg = {
-            'message': 'Invalid token',
-            'authenticated': False,
-            'invalid': True
-        }
-        expired_msg = {
-            'message': 'Expired token',
-            'authenticated': False,
-            'invalid': True
-        }
-
-        if len(auth_headers) != 2:
-            return jsonify(invalid_msg), 401
-
-        try:
-            token = auth_headers[1]
-            data = jwt.decode(
-                token, app.config['SECRET_KEY'], algorithms="HS256")
-            if data['role'] != "user":
-                return jsonify(invalid_msg), 401
-            user = User.query.filter_by(email=data['email']).first()
-            if not user:
-                raise RuntimeError('User not found')
-            return fun(user, *args, **kwargs)
-        except jwt.ExpiredSignatureError:
-            return jsonify(expired_msg), 401
-        except (jwt.InvalidTokenError, Exception) as e:
-            print(e)
-            return jsonify(invalid_msg), 401
-
-    return _verify
+        if book.section_id in books_dict:
+            books_dict[book.section_id].append(catalog.book_data(book))
+    return [dict(id=section.section_id, name=section.name, description=section.description,
+                 books=catalog.apply_overlay(books_dict[section.section_id], overlay)) for section in sections]
 
 
 def validate(check):
@@ -97,10 +58,8 @@ def user_login():
         'role': "user",
     }, app.config['SECRET_KEY'])
 
-    visited = VisitHistory(user_id=user.email, on=datetime.date.today())
-    db.session.add(visited)
-    db.session.commit()
-    online_users.add(user)
+    visits.record(user.email)
+    presence.heartbeat(user.email)
 
     return jsonify({'token': token, 'user_details': user.return_data()}), 200
 
@@ -137,6 +96,9 @@ def read_book(user, book_id):
     if book is None:
         return {"error": "does not exist"}, 404
     if user.email == book.user_email:
+        if book.pdf_status in ("pending", "failed"):
+            # generation is still running on a worker, or it failed
+            return jsonify(dict(book=book.return_data(), url="", pdf_status=book.pdf_status)), 202 if book.pdf_status == "pending" else 200
         if book.file_name:
             return jsonify(dict(url=url_for('static', filename=f"{book.file_name}"), book=book.return_data()))
         return jsonify(dict(book=book.return_data(), url=""))
@@ -145,36 +107,46 @@ def read_book(user, book_id):
 
 @app.route("/user/books", methods=["GET"])
 @token_required
-@cache.memoize(timeout=3600)
-def all_books(user):
-    books = Book.query.all()
-    response = calculate_rating(user, books)
+@versioned("books", lambda user: f"user:{user.email}")
+@paginated
+def all_books(user, page):
+    if page is None:
+        response = catalog.user_books(user)
+    else:
+        response = catalog.user_books_page(user, *page)
     return jsonify(response), 200
 
 
 @app.route("/user/accessible/books", methods=["GET"])
 @token_required
-@cache.memoize(timeout=3600)
 def accessible_books(user):
-    books = user.books
-    response = calculate_rating(user, books)
+    response = catalog.user_accessible_books(user)
     return jsonify(response), 200
 
 
 @app.route("/user/sections", methods=["GET"])
 @token_required
-@cache.memoize(timeout=3600)
-def all_sections(user):
-    sections = Section.query.all()
-    books_dict = {}
-    for section in sections:
-        books_dict[section.section_id] = calculate_rating(user, section.books)
-    response = [section.return_data() for section in sections]
-    for section in response:
-        section["books"] = books_dict[section["id"]]
+@versioned("books", lambda user: f"user:{user.email}")
+@paginated
+def all_sections(user, page):
+    if page is None:
+        response = catalog.user_sections(user)
+    else:
+        response = catalog.user_sections_page(user, *page)
     return jsonify(response), 200
 
 
+@app.route("/user/sections/<int:section_id>/books", methods=["GET"])
+@token_required
+@versioned("books", lambda user: f"user:{user.email}")
+@paginated
+def user_section_books(user, section_id, page):
+    # continues a section from the books_cursor of /user/sections
+    if page is None:
+        return {"error": "only available paginated"}, 400
+    return jsonify(catalog.user_books_page(user, *page, section_id=section_id)), 200
+
+
 @app.route("/user/bookread/<string:book_id>", methods=["GET"])
 @token_required
 def book_read(user, book_id):
@@ -185,13 +157,13 @@ def book_read(user, book_id):
     if book.user_email != user.email:
         return {"error": "No Access"}, 401
     for readbook in user.hasread:
-        if int(readbook.book_id) == book.book_id:
+        if readbook.book_id == book.book_id:
             return {"error": "Already marked as read"}, 401
     readbook = Read(user_id=user.email, book_id=book_id,
                     on=datetime.date.today())
     db.session.add(readbook)
     db.session.commit()
-    cache.delete_memoized(user_profile, user)
+    invalidation.user_changed(user.email)
     return {"message": "done"}, 200
 
 
@@ -202,14 +174,14 @@ def request_book(user, book_id):
     found = False
     requests = user.requests
     for i in user.books:
-        if (int(i.book_id) == book_id):
+        if i.book_id == book_id:
             found = True
     if found:
         return {"message": "Already in Possession"}, 200
     if len(user.books) >= 5:
         return {"error": "Max Books in Possession"}, 401
     for i in requests:
-        if int(i.book_id) == book.book_id and int(i.pending):
+        if i.book_id == book.book_id and i.pending:
             return {"message": "Already Requested"}, 200
     if book is None:
         return {"error": "Book does not exist"}, 401
@@ -217,6 +189,7 @@ def request_book(user, book_id):
                        pending=True, opened_on=datetime.date.today())
     db.session.add(request)
     db.session.commit()
+    invalidation.requests_changed()
     return {"message": "Requested"}, 200
 
 
@@ -225,7 +198,7 @@ def request_book(user, book_id):
 def return_book(user, book_id):
     found = False
     for book in user.books:
-        if int(book.book_id) == book_id:
+        if book.book_id == book_id:
             found = True
             break
     if found:
@@ -234,9 +207,8 @@ def return_book(user, book_id):
         db.session.add(book)
         db.session.commit()
         # invalidate cache
-        cache.delete_memoized(accessible_books, user)
-        cache.delete_memoized(all_books, user)
-        cache.delete_memoized(all_sections, user)
+        invalidation.book_changed(book_id)
+        invalidation.user_changed(user.email)
         return {"message": "returned"}, 200
 
     return {"error": "Not able to process"}, 401
@@ -246,11 +218,15 @@ def return_book(user, book_id):
 @token_required
 @validate(["rating", "feedback"])
 def user_feedback(user, book_id):
+    data = request.get_json()
+    # the rating feeds the aggregate the catalog is ordered by
+    rating = str(data.get("rating")).strip()
+    if not rating.isdigit() or not 1 <= int(rating) <= app.config["MAX_RATING"]:
+        return {"error": f"rating must be a whole number from 1 to {app.config['MAX_RATING']}"}, 400
+    rating = int(rating)
     for i in user.feedbacks:
-        if int(i.book_id) == book_id:
+        if i.book_id == book_id:
             return {"error": "Already Given"}, 401
-    data = request.get_json()
-    rating = data.get("rating")
     feedback_str = data.get("feedback")
     feedback = Feedback(
         book_id=book_id,
@@ -260,10 +236,10 @@ def user_feedback(user, book_id):
         on=datetime.date.today()
     )
     db.session.add(feedback)
+    Book.add_rating(book_id, rating)
     db.session.commit()
-    cache.delete_memoized(all_books, user)
-    cache.delete_memoized(all_sections, user)
-    cache.delete_memoized(accessible_books, user)
+    invalidation.book_changed(book_id)
+    invalidation.catalog_changed()
     return {"message": "Feedback registered"}, 200
 
 
@@ -272,12 +248,8 @@ def user_feedback(user, book_id):
 @validate(["key", "index"])
 def user_search_books(user):
     data = request.get_json()
-    search_key = '%'+data.get('key')+'%'
-    index = data.get('index')
-    if index == '1':
-        books = Book.query.filter(Book.name.like(search_key)).all()
-    else:
-        books = Book.query.filter(Book.authors.like(search_key)).all()
+    books = search.search_books(data.get('key'), search.book_columns(
+        data.get('index')), limit=data.get('limit'))
     reponse = calculate_rating(user, books)
     return jsonify(reponse), 200
 
@@ -287,20 +259,8 @@ def user_search_books(user):
 @validate(["key", "index"])
 def user_search_accessible_books(user):
     data = request.get_json()
-    search_key = '%'+data.get('key')+'%'
-    index = data.get('index')
-    if index == '1':
-        books = Book.query.filter(Book.name.like(search_key)).all()
-        user_books = []
-        for book in books:
-            if book.user_email == user.email:
-                user_books.append(book)
-    else:
-        books = Book.query.filter(Book.authors.like(search_key)).all()
-        user_books = []
-        for book in books:
-            if book.user_email == user.email:
-                user_books.append(book)
+    user_books = search.search_books(data.get('key'), search.book_columns(data.get('index')),
+                                     query=Book.query.filter(Book.user_email == user.email), limit=data.get('limit'))
     reponse = calculate_rating(user, user_books)
     return jsonify(reponse), 200
 
@@ -310,29 +270,30 @@ def user_search_accessible_books(user):
 @validate(["key"])
 def user_search_sections(user):
     data = request.get_json()
-    search_key = '%'+data.get('key')+'%'
-    sections = Section.query.filter(Section.name.like(search_key)).all()
-    books_dict = {}
-    for section in sections:
-        books_dict[section.section_id] = calculate_rating(user, section.books)
-    response = [section.return_data() for section in sections]
-    for section in response:
-        section["books"] = books_dict[section["id"]]
+    sections = search.search_sections(data.get('key'), limit=data.get('limit'))
+    books = Book.by_rating().filter(
+        Book.section_id.in_([section.section_id for section in sections]))
+    response = sections_with_books(user, sections, books)
     return jsonify(response), 200
 
 
 @app.route("/user/profile", methods=["GET"])
 @token_required
-@cache.memoize(3600)
 def user_profile(user):
-    data = db.session.query(Book, Read).join(
-        Read, Read.book_id == Book.book_id).filter(Read.user_id == user.email).all()
-    books = []
-    for book, read in data:
-        temp = book.return_data()
-        temp["on"] = read.on
-        books.append(temp)
-    return jsonify({"user_name": user.nick_name, "user": user.return_data(), "books": books}), 200
+    def compute():
+        data = db.session.query(Book, Read).join(
+            Read, Read.book_id == Book.book_id).filter(Read.user_id == user.email).all()
+        books = []
+        for book, read in data:
+            temp = book.return_data()
+            temp["on"] = read.on
+            books.append(temp)
+        # cached for longer than the principal snapshot lives, read the row
+        record = user.record
+        return {"user_name": record.nick_name, "user": record.return_data(), "books": books}
+    response = invalidation.remember(invalidation.tagged_key(
+        f"profile:{user.email}", f"user:{user.email}", "catalog"), compute)
+    return jsonify(response), 200
 
 
 @app.route("/user/profile/edit", methods=["POST"])
@@ -350,9 +311,10 @@ def user_profile_edit(user):
     user.last_name = lname
     user.phone_number = cno
     user.about = about
-    db.session.add(user)
+    db.session.add(user.record)
     db.session.commit()
-    cache.delete_memoized(user_profile, user)
+    auth.forget("user", user.email)
+    invalidation.user_changed(user.email)
     return {"message": "done"}, 200
 
 
@@ -363,23 +325,27 @@ def buy_book(user, book_id):
     if book is None:
         return {"error", "book does not exist"}, 404
     for i in user.owns:
-        if int(i.book_id) == book_id:
+        if i.book_id == book_id:
             return {"message": "already owned"}, 200
     owner = Owner(user_email=user.email, book_id=book_id)
     db.session.add(owner)
     db.session.commit()
-    cache.delete_memoized(all_books, user)
-    cache.delete_memoized(all_sections, user)
-    cache.delete_memoized(accessible_books, user)
+    invalidation.user_changed(user.email)
     return {"message": "done"}, 200
 
 
 @app.route("/user/checkfeedback/<int:book_id>")
 @token_required
-def check_feedback(user, book_id):
+@paginated
+def check_feedback(user, book_id, page):
     feedbacks = Feedback.query.filter_by(book_id=book_id)
+    if page is None:
+        response = [feedback.return_data() for feedback in feedbacks]
+        return jsonify(response)
+    feedbacks, next_cursor = keyset(
+        feedbacks, [Feedback.feedback_id], *page)
     response = [feedback.return_data() for feedback in feedbacks]
-    return jsonify(response)
+    return jsonify(make_page(response, next_cursor))
 
 
 @app.route("/user/download/<int:book_id>")
@@ -389,18 +355,16 @@ def download_book(user, book_id):
     if book is None:
         return {"error": "book does not exist"}, 404
     for i in user.owns:
-        if int(i.book_id) == book_id:
+        if i.book_id == book_id:
             if book.file_name:
-                return send_from_directory(app.config["UPLOAD_FOLDER"], book.file_name), 200
+                # no forced status, conditional and range answers are 304 and 206
+                return send_from_directory(app.config["UPLOAD_FOLDER"], book.file_name)
     return {"error": "no access"}, 403
 
 
 @app.route("/user/logout", methods=["GET"])
 @token_required
 def logout(user):
-    global online_users
-    try:
-        online_users.remove(user)
-    except:
-        pass
+    presence.leave(user.email)
+    auth.forget("user", user.email)
     return {"message": "done"}, 200